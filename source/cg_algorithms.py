@@ -1,7 +1,11 @@
 from enum import Enum
 from typing import Tuple, List
 from abc import ABC, abstractmethod
-from math import atan2, cos, sin, degrees, radians, sqrt
+from functools import lru_cache
+from collections import OrderedDict
+from math import cos, sin, radians, sqrt, factorial
+import copy
+import numpy as np
 
 
 Point = Tuple[int, int]
@@ -19,72 +23,196 @@ class ColorTable():
     YELLOW = (255, 255, 0)
 
 
+class ShapeCache():
+    def __init__(self, capacity: int):
+        # capacity counts buffer rows, i.e. pixels or spans
+        self.capacity = capacity
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def get(self, key) -> np.ndarray:
+        ret = self.entries.get(key)
+        if ret is not None:
+            self.entries.move_to_end(key)
+        return ret
+
+    def put(self, key, value: np.ndarray) -> None:
+        if len(value) > self.capacity or key in self.entries:
+            return
+        value.flags.writeable = False
+        self.entries[key] = value
+        self.size += len(value)
+        while self.size > self.capacity:
+            _, old = self.entries.popitem(last=False)
+            self.size -= len(old)
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.size = 0
+
+
 class Primitive(ABC):
     class PType(Enum):
         line = 0
         polygon = 1
         ellipse = 2
         curve = 3
+        filledPolygon = 4
+
+    # set by primitives whose _render never yields the same pixel twice
+    uniqueRender = False
+    NO_SPANS = np.empty((0, 3), np.int32)
+    # rasters of translation-invariant shapes, relative to their anchor point
+    shapeCache = ShapeCache(1 << 22)
 
     def __init__(self, t: PType):
         self.saved = None
+        self.pending = None
         self.type = t
 
+    def invalidate(self) -> None:
+        self.saved = None
+
+    def clone(self) -> "Primitive":
+        # mutators always rebind attributes rather than change them in place,
+        # so a shallow copy can be changed without touching the original
+        return copy.copy(self)
+
     @abstractmethod
-    def boundingRect(self):
+    def _boundingRect(self):
         pass
 
+    def boundingRect(self):
+        self.applyTransform()
+        return self._boundingRect()
+
+    def controlPoints(self) -> List[Point]:
+        # every pixel lies within one pixel of the box around these points
+        return []
+
+    def bounds(self) -> Tuple[int, int, int, int]:
+        # inclusive (x0, y0, x1, y1) box holding every pixel, found without
+        # applying pending transforms; None when nothing is drawn
+        points = np.asarray(self.controlPoints(), np.float64).reshape(-1, 2)
+        if not len(points):
+            return None
+        if self.pending is not None:
+            points = points @ self.pending[:2, :2].T + self.pending[:2, 2]
+        (x0, y0), (x1, y1) = np.floor(points.min(axis=0)) - 1, np.ceil(points.max(axis=0)) + 1
+        return int(x0), int(y0), int(x1), int(y1)
+
     @abstractmethod
-    def _render(self) -> List[Point]:
+    def _render(self) -> np.ndarray:
         pass
 
-    def render(self) -> List[Point]:
-        if not self.saved:
-            self.saved = list(dict.fromkeys(self._render()))
+    @staticmethod
+    def toPixels(points) -> np.ndarray:
+        return np.ascontiguousarray(np.reshape(points, (-1, 2)), np.int32)
+
+    @staticmethod
+    def uniquePixels(pixels: np.ndarray) -> np.ndarray:
+        # every (x, y) row of an int32 buffer is viewed as a single int64 key
+        pixels = Primitive.toPixels(pixels)
+        _, index = np.unique(pixels.view(np.int64).ravel(), return_index=True)
+        if len(index) == len(pixels):
+            return pixels
+        return pixels[np.sort(index)]
+
+    def spans(self) -> np.ndarray:
+        # horizontal runs (y, x0, x1) drawn in addition to render()
+        return self.NO_SPANS
+
+    def shapeKey(self):
+        # (key, anchor) for primitives whose raster only shifts when the
+        # primitive is translated by whole pixels, None otherwise
+        return None
+
+    def rasterize(self) -> np.ndarray:
+        if self.uniqueRender:
+            return self.toPixels(self._render())
+        return self.uniquePixels(self._render())
+
+    def render(self) -> np.ndarray:
+        self.applyTransform()
+        if self.saved is None:
+            shape = self.shapeKey()
+            if shape is None:
+                self.saved = self.rasterize()
+            else:
+                key, anchor = shape
+                anchor = np.array(anchor, np.int32)
+                relative = self.shapeCache.get(key)
+                if relative is None:
+                    self.saved = self.rasterize()
+                    self.shapeCache.put(key, self.saved - anchor)
+                else:
+                    self.saved = relative + anchor
         return self.saved
 
     @abstractmethod
-    def _translate(self, dx: int, dy: int) -> None:
+    def _transform(self, m: np.ndarray) -> None:
         pass
 
-    @abstractmethod
-    def _rotate(self, x: int, y: int, r: int) -> None:
-        pass
+    @staticmethod
+    def transformPoints(m: np.ndarray, points) -> List[Point]:
+        points = np.asarray(points, np.float64).reshape(-1, 2)
+        return list(map(tuple, np.rint(points @ m[:2, :2].T + m[:2, 2]).astype(np.int64).tolist()))
 
-    @abstractmethod
-    def _scale(self, x: int, y: int, s: float) -> None:
-        pass
+    def applyTransform(self) -> None:
+        if self.pending is not None:
+            m = self.pending
+            self.pending = None
+            self._transform(m)
+
+    def transform(self, m: np.ndarray) -> None:
+        # transforms are only composed here and applied on the next
+        # render() or boundingRect(), so repeated edits round just once
+        self.invalidate()
+        self.pending = m if self.pending is None else m @ self.pending
 
     def translate(self, dx: int, dy: int) -> None:
-        self.saved = None
-        self._translate(dx, dy)
+        self.transform(self.translateMatrix(dx, dy))
 
     def rotate(self, x: int, y: int, r: int) -> None:
-        self.saved = None
-        self._rotate(x, y, r)
+        self.transform(self.rotateMatrix(x, y, r))
 
     def scale(self, x: int, y: int, s: float) -> None:
-        self.saved = None
-        self._scale(x, y, s)
-
-    def translatePoint(self, x0: int, y0: int, dx: int, dy: int) -> Point:
-        return (round(x0+dx), round(y0+dy))
-
-    def rotatePoint(self, x0: int, y0: int, x: int, y: int, r: int) -> Point:
-        dx = x0 - x
-        dy = y0 - y
-        l = sqrt(dx**2+dy**2)
-        degree = degrees(atan2(float(dy), float(dx)))
-        radian = radians(degree + r)
-        return (round(x+l*cos(radian)), round(y+l*sin(radian)))
-
-    def scalePoint(self, x0: int, y0: int, x: int, y: int, s: float) -> Point:
-        return (round(x0*s+(1-s)*x), round(y0*s+(1-s)*y))
+        self.transform(self.scaleMatrix(x, y, s))
+
+    @staticmethod
+    def translateMatrix(dx: int, dy: int) -> np.ndarray:
+        return np.array([
+            [1.0, 0.0, dx],
+            [0.0, 1.0, dy],
+            [0.0, 0.0, 1.0],
+        ])
+
+    @staticmethod
+    def rotateMatrix(x: int, y: int, r: int) -> np.ndarray:
+        c = cos(radians(r))
+        s = sin(radians(r))
+        return np.array([
+            [c, -s, x - c * x + s * y],
+            [s, c, y - s * x - c * y],
+            [0.0, 0.0, 1.0],
+        ])
+
+    @staticmethod
+    def scaleMatrix(x: int, y: int, s: float) -> np.ndarray:
+        return np.array([
+            [s, 0.0, (1 - s) * x],
+            [0.0, s, (1 - s) * y],
+            [0.0, 0.0, 1.0],
+        ])
 
     @abstractmethod
-    def __str__(self):
+    def _str(self) -> str:
         pass
 
+    def __str__(self):
+        self.applyTransform()
+        return self._str()
+
 
 class Line(Primitive):
     class Algorithm(Enum):
@@ -103,7 +231,24 @@ class Line(Primitive):
         self.y1 = y1
         self.algorithm = algorithm
 
-    def boundingRect(self):
+    def setEnds(self, x0: int, y0: int, x1: int, y1: int) -> None:
+        self.invalidate()
+        self.x0 = x0
+        self.y0 = y0
+        self.x1 = x1
+        self.y1 = y1
+
+    def shapeKey(self):
+        # DDA accumulates floats from the absolute start point, so only
+        # Bresenham is exactly invariant under translation
+        if self.algorithm != self.Algorithm.Bresenham:
+            return None
+        return (self.type, self.algorithm, self.x1 - self.x0, self.y1 - self.y0), (self.x0, self.y0)
+
+    def controlPoints(self) -> List[Point]:
+        return [(self.x0, self.y0), (self.x1, self.y1)]
+
+    def _boundingRect(self):
         x = (self.x0, self.x1)
         y = (self.y0, self.y1)
         return min(x)-1, min(y)-1, max(x)-min(x)+2, max(y)-min(y)+2
@@ -153,25 +298,81 @@ class Line(Primitive):
         ret.append((x, y))
         return ret
 
-    def _render(self) -> List[Point]:
-        if self.algorithm == self.Algorithm.DDA:
-            return self.render_DDA()
-        elif self.algorithm == self.Algorithm.Bresenham:
-            return self.render_Bresenham()
+    @staticmethod
+    def batch_DDA(x0: np.ndarray, y0: np.ndarray, x1: np.ndarray, y1: np.ndarray) -> np.ndarray:
+        dx0 = x1 - x0
+        dy0 = y1 - y0
+        length = np.maximum(np.abs(dx0), np.abs(dy0))
+        step = np.maximum(length, 1)
+        dx = dx0 / step
+        dy = dy0 / step
+
+        # the increments have to be accumulated one by one, exactly like
+        # render_DDA does, so lines are bucketed by length to keep padding low
+        ret = np.empty((int(np.sum(length + 1)), 2), np.int64)
+        offsets = np.cumsum(length + 1) - (length + 1)
+        buckets = np.frexp(length.astype(np.float64))[1]
+        for bucket in np.unique(buckets):
+            idx = np.nonzero(buckets == bucket)[0]
+            width = int(length[idx].max()) + 1
+            xs = np.empty((len(idx), width))
+            ys = np.empty((len(idx), width))
+            xs[:, 0] = x0[idx]
+            ys[:, 0] = y0[idx]
+            xs[:, 1:] = dx[idx, None]
+            ys[:, 1:] = dy[idx, None]
+            np.add.accumulate(xs, axis=1, out=xs)
+            np.add.accumulate(ys, axis=1, out=ys)
+            mask = np.arange(width) <= length[idx, None]
+            rows = (offsets[idx, None] + np.arange(width))[mask]
+            ret[rows, 0] = np.rint(xs[mask])
+            ret[rows, 1] = np.rint(ys[mask])
+        return ret
+
+    @staticmethod
+    def batch_Bresenham(x0: np.ndarray, y0: np.ndarray, x1: np.ndarray, y1: np.ndarray) -> np.ndarray:
+        dx0 = np.abs(x1 - x0)
+        dy0 = np.abs(y1 - y0)
+        sx = np.where(x0 > x1, -1, 1)
+        sy = np.where(y0 > y1, -1, 1)
+        xmajor = dx0 > dy0
+        major = np.where(xmajor, dx0, dy0)
+        minor = np.where(xmajor, dy0, dx0)
+
+        counts = major + 1
+        line = np.repeat(np.arange(len(major)), counts)
+        i = np.arange(int(np.sum(counts))) - np.repeat(np.cumsum(counts) - counts, counts)
+
+        # closed form of the error term: the minor coordinate has moved
+        # ceil((2 * i * minor - major) / (2 * major)) times after i steps
+        major2 = 2 * np.maximum(major[line], 1)
+        m = -((major[line] - 2 * i * minor[line]) // major2)
+        xm = xmajor[line]
+
+        ret = np.empty((len(i), 2), np.int64)
+        ret[:, 0] = x0[line] + sx[line] * np.where(xm, i, m)
+        ret[:, 1] = y0[line] + sy[line] * np.where(xm, m, i)
+        return ret
+
+    @staticmethod
+    def render_batch(x0, y0, x1, y1, algorithm: Algorithm) -> np.ndarray:
+        x0 = np.asarray(x0, np.int64)
+        y0 = np.asarray(y0, np.int64)
+        x1 = np.asarray(x1, np.int64)
+        y1 = np.asarray(y1, np.int64)
+        if algorithm == Line.Algorithm.DDA:
+            return Line.batch_DDA(x0, y0, x1, y1)
+        elif algorithm == Line.Algorithm.Bresenham:
+            return Line.batch_Bresenham(x0, y0, x1, y1)
         else:
             raise TypeError("Invalid line algorithm")
 
-    def _translate(self, dx: int, dy: int) -> None:
-        self.x0, self.y0 = self.translatePoint(self.x0, self.y0, dx, dy)
-        self.x1, self.y1 = self.translatePoint(self.x1, self.y1, dx, dy)
-
-    def _rotate(self, x: int, y: int, r: int) -> None:
-        self.x0, self.y0 = self.rotatePoint(self.x0, self.y0, x, y, r)
-        self.x1, self.y1 = self.rotatePoint(self.x1, self.y1, x, y, r)
+    def _render(self) -> np.ndarray:
+        return self.render_batch([self.x0], [self.y0], [self.x1], [self.y1], self.algorithm)
 
-    def _scale(self, x: int, y: int, s: float) -> None:
-        self.x0, self.y0 = self.scalePoint(self.x0, self.y0, x, y, s)
-        self.x1, self.y1 = self.scalePoint(self.x1, self.y1, x, y, s)
+    def _transform(self, m: np.ndarray) -> None:
+        (self.x0, self.y0), (self.x1, self.y1) = self.transformPoints(
+            m, [(self.x0, self.y0), (self.x1, self.y1)])
 
     def clip_Cohen_Sutherland(self, cx0: int, cy0: int, cx1: int, cy1: int) -> bool:
         INSIDE = 0
@@ -310,8 +511,110 @@ class Line(Primitive):
 
         return True
 
+    @staticmethod
+    def batch_Cohen_Sutherland(x0: np.ndarray, y0: np.ndarray, x1: np.ndarray, y1: np.ndarray,
+                               xmin: int, ymin: int, xmax: int, ymax: int):
+        LEFT = 1
+        RIGHT = 2
+        BOTTOM = 4
+        TOP = 8
+
+        def encode(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+            return (np.where(x < xmin, LEFT, np.where(x > xmax, RIGHT, 0)) |
+                    np.where(y < ymin, BOTTOM, np.where(y > ymax, TOP, 0)))
+
+        x0, y0 = x0.astype(np.float64), y0.astype(np.float64)
+        x1, y1 = x1.astype(np.float64), y1.astype(np.float64)
+        code0 = encode(x0, y0)
+        code1 = encode(x1, y1)
+        accept = np.zeros(len(x0), bool)
+
+        # every pass moves one endpoint of each undecided segment onto a
+        # window edge, in the same order as clip_Cohen_Sutherland does
+        active = np.arange(len(x0))
+        while len(active):
+            c0, c1 = code0[active], code1[active]
+            accept[active[(c0 | c1) == 0]] = True
+            keep = ((c0 | c1) != 0) & ((c0 & c1) == 0)
+            active, c0, c1 = active[keep], c0[keep], c1[keep]
+            if not len(active):
+                break
+
+            ax0, ay0, ax1, ay1 = x0[active], y0[active], x1[active], y1[active]
+            codet = np.maximum(c0, c1)
+            top = (codet & TOP) != 0
+            bottom = ~top & ((codet & BOTTOM) != 0)
+            right = ~top & ~bottom & ((codet & RIGHT) != 0)
+            x = np.full(len(active), float(xmin))
+            y = np.zeros(len(active))
+            with np.errstate(divide="ignore", invalid="ignore"):
+                x = np.where(top, ax0 + (ax1-ax0)*(ymax-ay0)/(ay1-ay0), x)
+                x = np.where(bottom, ax0 + (ax1-ax0)*(ymin-ay0)/(ay1-ay0), x)
+                x = np.where(right, xmax, x)
+                y = np.where(top, ymax, np.where(bottom, ymin, ay0 + (ay1-ay0)*(
+                    np.where(right, xmax, xmin)-ax0)/(ax1-ax0)))
+
+            first = codet == c0
+            i0, i1 = active[first], active[~first]
+            x0[i0], y0[i0] = x[first], y[first]
+            x1[i1], y1[i1] = x[~first], y[~first]
+            code0[i0] = encode(x0[i0], y0[i0])
+            code1[i1] = encode(x1[i1], y1[i1])
+
+        return accept, np.trunc(x0).astype(np.int64), np.trunc(y0).astype(np.int64), \
+            np.trunc(x1).astype(np.int64), np.trunc(y1).astype(np.int64)
+
+    @staticmethod
+    def batch_Liang_Barsky(x0: np.ndarray, y0: np.ndarray, x1: np.ndarray, y1: np.ndarray,
+                           xmin: int, ymin: int, xmax: int, ymax: int):
+        p1 = -(x1 - x0)
+        p3 = -(y1 - y0)
+        q1, q2 = x0 - xmin, xmax - x0
+        q3, q4 = y0 - ymin, ymax - y0
+
+        reject = ((p1 == 0) & ((q1 < 0) | (q2 < 0))) | ((p3 == 0) & ((q3 < 0) | (q4 < 0)))
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            r1, r2 = q1 / p1, q2 / -p1
+            r3, r4 = q3 / p3, q4 / -p3
+        rn1 = np.maximum(np.where(p1 == 0, 0.0, np.where(p1 < 0, r1, r2)),
+                         np.where(p3 == 0, 0.0, np.where(p3 < 0, r3, r4)))
+        rn1 = np.maximum(rn1, 0.0)
+        rn2 = np.minimum(np.where(p1 == 0, 1.0, np.where(p1 < 0, r2, r1)),
+                         np.where(p3 == 0, 1.0, np.where(p3 < 0, r4, r3)))
+        rn2 = np.minimum(rn2, 1.0)
+        accept = ~reject & (rn1 <= rn2)
+
+        with np.errstate(invalid="ignore"):
+            nx0 = np.where(accept, np.rint(x0 - p1 * rn1), x0).astype(np.int64)
+            ny0 = np.where(accept, np.rint(y0 - p3 * rn1), y0).astype(np.int64)
+            nx1 = np.where(accept, np.rint(x0 - p1 * rn2), x1).astype(np.int64)
+            ny1 = np.where(accept, np.rint(y0 - p3 * rn2), y1).astype(np.int64)
+        return accept, nx0, ny0, nx1, ny1
+
+    @staticmethod
+    def clip_batch(x0, y0, x1, y1, cx0: int, cy0: int, cx1: int, cy1: int, algorithm: ClipAlgorithm):
+        x0 = np.asarray(x0, np.int64)
+        y0 = np.asarray(y0, np.int64)
+        x1 = np.asarray(x1, np.int64)
+        y1 = np.asarray(y1, np.int64)
+        if cx0 == cx1 and cy0 == cy1:
+            return np.zeros(len(x0), bool), x0, y0, x1, y1
+
+        if cx0 > cx1:
+            cx0, cx1 = cx1, cx0
+        if cy0 > cy1:
+            cy0, cy1 = cy1, cy0
+        if algorithm == Line.ClipAlgorithm.Cohen_Sutherland:
+            return Line.batch_Cohen_Sutherland(x0, y0, x1, y1, cx0, cy0, cx1, cy1)
+        elif algorithm == Line.ClipAlgorithm.Liang_Barsky:
+            return Line.batch_Liang_Barsky(x0, y0, x1, y1, cx0, cy0, cx1, cy1)
+        else:
+            raise TypeError("Invalid clip algorithm")
+
     def clip(self, x0: int, y0: int, x1: int, y1: int, algorithm: ClipAlgorithm) -> bool:
-        self.saved = None
+        self.applyTransform()
+        self.invalidate()
 
         if x0 == x1 and y0 == y1:
             return False
@@ -327,7 +630,7 @@ class Line(Primitive):
         else:
             raise TypeError("Invalid clip algorithm")
 
-    def __str__(self):
+    def _str(self):
         return f"Line ({self.x0}, {self.y0})\u2192({self.x1}, {self.y1})"
 
 
@@ -338,12 +641,32 @@ class Polygon(Primitive):
         if not points:
             raise ValueError("Points number should be greater than 0")
         self.algorithm = algorithm
+        self.setPoints(points)
+
+    def setPoints(self, points: List[Point]) -> None:
+        self.invalidate()
         self.lines: List[Line] = []
         for i in range(len(points)):
             self.lines.append(
-                Line(points[i-1][0], points[i-1][1], points[i][0], points[i][1], algorithm))
+                Line(points[i-1][0], points[i-1][1], points[i][0], points[i][1], self.algorithm))
 
-    def boundingRect(self):
+    def getPoints(self) -> List[Point]:
+        return [(l.x1, l.y1) for l in self.lines]
+
+    def controlPoints(self) -> List[Point]:
+        return self.getPoints()
+
+    def vertexKey(self):
+        points = np.array(self.getPoints(), np.int64)
+        return (points - points[0]).tobytes(), tuple(points[0].tolist())
+
+    def shapeKey(self):
+        if self.algorithm != Line.Algorithm.Bresenham:
+            return None
+        key, anchor = self.vertexKey()
+        return (self.type, self.algorithm, key), anchor
+
+    def _boundingRect(self):
         x = []
         y = []
         for l in self.lines:
@@ -354,29 +677,159 @@ class Polygon(Primitive):
             y.append(y0+yl-1)
         return min(x)-1, min(y)-1, max(x)-min(x)+2, max(y)-min(y)+2
 
-    def _render(self) -> List[Point]:
-        ret = []
-        for line in self.lines:
-            ret += line.render()
-        return ret
+    def _render(self) -> np.ndarray:
+        ends = np.array([(l.x0, l.y0, l.x1, l.y1) for l in self.lines], np.int64)
+        return Line.render_batch(ends[:, 0], ends[:, 1], ends[:, 2], ends[:, 3], self.algorithm)
+
+    def _transform(self, m: np.ndarray) -> None:
+        self.setPoints(self.transformPoints(m, self.getPoints()))
+
+    @staticmethod
+    def clipEdge(points: np.ndarray, axis: int, bound: int, keepBelow: bool,
+                 algorithm: Line.ClipAlgorithm) -> np.ndarray:
+        # one Sutherland-Hodgman pass against the boundary points[:, axis] = bound
+        if not len(points):
+            return points
+        prev = np.roll(points, 1, axis=0)
+        inside = points[:, axis] <= bound if keepBelow else points[:, axis] >= bound
+        crossing = inside != np.roll(inside, 1)
+
+        p0, p1 = prev[crossing], points[crossing]
+        a, b = p0[:, axis], p1[:, axis]
+        o0, o1 = p0[:, 1-axis], p1[:, 1-axis]
+        cross = np.empty((len(p0), 2))
+        cross[:, axis] = bound
+        if algorithm == Line.ClipAlgorithm.Cohen_Sutherland:
+            cross[:, 1-axis] = o0 + (o1-o0)*(bound-a)/(b-a)
+        elif algorithm == Line.ClipAlgorithm.Liang_Barsky:
+            t = (bound - a) / (b - a)
+            cross[:, 1-axis] = o0 + t * (o1 - o0)
+        else:
+            raise TypeError("Invalid clip algorithm")
 
-    def _translate(self, dx: int, dy: int) -> None:
-        for line in self.lines:
-            line.translate(dx, dy)
+        # each edge emits its crossing point first and then its end point
+        candidates = np.empty((len(points), 2, 2))
+        candidates[crossing, 0] = cross
+        candidates[:, 1] = points
+        return candidates[np.stack((crossing, inside), axis=1)]
 
-    def _rotate(self, x: int, y: int, r: int) -> None:
-        for line in self.lines:
-            line.rotate(x, y, r)
+    def clip(self, x0: int, y0: int, x1: int, y1: int, algorithm: Line.ClipAlgorithm) -> bool:
+        self.applyTransform()
 
-    def _scale(self, x: int, y: int, s: float) -> None:
-        for line in self.lines:
-            line.scale(x, y, s)
+        if x0 == x1 and y0 == y1:
+            return False
 
-    def __str__(self):
+        if x0 > x1:
+            x0, x1 = x1, x0
+        if y0 > y1:
+            y0, y1 = y1, y0
+        points = np.array(self.getPoints(), np.float64)
+        points = self.clipEdge(points, 0, x0, False, algorithm)
+        points = self.clipEdge(points, 0, x1, True, algorithm)
+        points = self.clipEdge(points, 1, y0, False, algorithm)
+        points = self.clipEdge(points, 1, y1, True, algorithm)
+        if not len(points):
+            return False
+
+        # round like the matching line clip does, then drop repeated vertices
+        if algorithm == Line.ClipAlgorithm.Cohen_Sutherland:
+            points = np.trunc(points).astype(np.int64)
+        else:
+            points = np.rint(points).astype(np.int64)
+        keep = np.any(points != np.roll(points, 1, axis=0), axis=1)
+        keep[0] = keep[0] or not keep.any()
+        self.setPoints(list(map(tuple, points[keep].tolist())))
+        return True
+
+    def _str(self):
         return f"Polygon ({self.lines[0].x0}, {self.lines[0].y0})..."
 
 
+class FilledPolygon(Polygon):
+
+    def __init__(self, points: List[Point], algorithm: Line.Algorithm):
+        super().__init__(points, algorithm)
+        self.type = Primitive.PType.filledPolygon
+
+    def invalidate(self) -> None:
+        super().invalidate()
+        self.savedSpans = None
+
+    def _spans(self) -> np.ndarray:
+        # Edge table sorted by the lowest scanline of each edge, and an active
+        # edge table holding the edges that cross the current scanline. Each
+        # scanline covers the half-open range [ymin, ymax) of an edge, and
+        # spans are taken between pairs of sorted crossings (even-odd rule).
+        points = np.array(self.getPoints(), np.int64)
+        p0, p1 = np.roll(points, 1, axis=0), points
+        edge = p0[:, 1] != p1[:, 1]
+        p0, p1 = p0[edge], p1[edge]
+        if not len(p0):
+            return self.NO_SPANS
+
+        low = np.where((p0[:, 1] < p1[:, 1])[:, None], p0, p1)
+        high = np.where((p0[:, 1] < p1[:, 1])[:, None], p1, p0)
+        order = np.argsort(low[:, 1], kind="stable")
+        ymin, ymax = low[order, 1], high[order, 1]
+        xbase = low[order, 0]
+        run = high[order, 0] - low[order, 0]
+        rise = ymax - ymin
+
+        ret = []
+        active = np.empty(0, np.int64)
+        pending = 0
+        y = int(ymin[0])
+        while pending < len(ymin) or len(active):
+            if not len(active):
+                y = max(y, int(ymin[pending]))
+            start = pending
+            while pending < len(ymin) and ymin[pending] <= y:
+                pending += 1
+            active = np.concatenate((active, np.arange(start, pending)))
+            active = active[ymax[active] > y]
+            if len(active):
+                # crossings are kept exact as whole part plus fraction, so the
+                # spans only shift when the polygon is translated
+                whole, part = np.divmod((y - ymin[active]) * run[active], rise[active])
+                whole += xbase[active]
+                fraction = part / rise[active]
+                rank = np.lexsort((fraction, whole))
+                whole, part = whole[rank], part[rank]
+                left = whole[0::2] + (part[0::2] > 0)
+                right = whole[1::2]
+                valid = left <= right
+                if valid.any():
+                    span = np.empty((int(valid.sum()), 3), np.int32)
+                    span[:, 0] = y
+                    span[:, 1] = left[valid]
+                    span[:, 2] = right[valid]
+                    ret.append(span)
+            y += 1
+
+        if not ret:
+            return self.NO_SPANS
+        return np.concatenate(ret)
+
+    def spans(self) -> np.ndarray:
+        self.applyTransform()
+        if self.savedSpans is None:
+            key, (ax, ay) = self.vertexKey()
+            key = ("spans", key)
+            anchor = np.array([ay, ax, ax], np.int32)
+            relative = self.shapeCache.get(key)
+            if relative is None:
+                self.savedSpans = self._spans()
+                self.shapeCache.put(key, self.savedSpans - anchor)
+            else:
+                self.savedSpans = relative + anchor
+        return self.savedSpans
+
+    def _str(self):
+        return "Filled" + super()._str()
+
+
 class Ellipse(Primitive):
+    uniqueRender = True
 
     def __init__(self, x0: int, y0: int, x1: int, y1: int):
         super().__init__(Primitive.PType.ellipse)
@@ -385,76 +838,139 @@ class Ellipse(Primitive):
         self.rx = round(abs(x1 - x0) / 2)
         self.ry = round(abs(y1 - y0) / 2)
 
-    def boundingRect(self):
+    def shapeKey(self):
+        return (self.type, self.rx, self.ry), (self.cx, self.cy)
+
+    def bounds(self) -> Tuple[int, int, int, int]:
+        cx, cy, rx, ry = self.cx, self.cy, abs(self.rx), abs(self.ry)
+        if self.pending is not None:
+            m = self.pending
+            cx, cy = m[:2, :2] @ (cx, cy) + m[:2, 2]
+            s = sqrt(abs(m[0, 0] * m[1, 1] - m[0, 1] * m[1, 0]))
+            rx, ry = rx * s, ry * s
+        return int(np.floor(cx - rx)) - 1, int(np.floor(cy - ry)) - 1, int(np.ceil(cx + rx)) + 1, int(np.ceil(cy + ry)) + 1
+
+    def _boundingRect(self):
         x = [self.cx - self.rx, self.cx + self.rx]
         y = [self.cy - self.ry, self.cy + self.ry]
         return min(x)-1, min(y)-1, max(x)-min(x)+2, max(y)-min(y)+2
 
-    def _render(self) -> List[Point]:
-        def draw4(l: List[Point], cx, cy, x, y):
-            l.append((round(cx + x), round(cy + y)))
-            l.append((round(cx + x), round(cy - y)))
-            l.append((round(cx - x), round(cy + y)))
-            l.append((round(cx - x), round(cy - y)))
-
+    NONE = -(1 << 40)
+    # quadrant() keeps every term below this in int64 arithmetic
+    INT64_LIMIT = 1 << 62
+
+    @staticmethod
+    def roundHalf(v: int) -> int:
+        # round(v / 2) with round-half-to-even, without leaving integers
+        q = v >> 1
+        return q + 1 if v & 1 and q & 1 else q
+
+    @staticmethod
+    def largestBelow(k: int, r: np.ndarray) -> np.ndarray:
+        # largest integer x with k * (2x - 1)^2 < r, or NONE if there is none
+        valid = k < r
+        x = np.floor((1 + np.sqrt(np.maximum(r, 0) / k)) / 2).astype(np.int64)
+        while True:
+            high = valid & (k * (2 * x - 1) ** 2 >= r)
+            low = valid & (k * (2 * x + 1) ** 2 < r)
+            if not high.any() and not low.any():
+                break
+            x = x - high + low
+        return np.where(valid, x, Ellipse.NONE)
+
+    def quadrantScalar(self) -> np.ndarray:
+        # the midpoint algorithm stepped one pixel at a time on Python ints,
+        # for radii whose decision variables do not fit in int64
+        a, b = self.rx, self.ry
+        aa, bb = a * a, b * b
         ret = []
-
-        x = self.rx
-        y = 0
-
-        taa = self.rx ** 2
-        t2aa = 2 * taa
-        t4aa = 2 * t2aa
-
-        tbb = self.ry ** 2
-        t2bb = 2 * tbb
-        t4bb = 2 * t2bb
-
-        t2abb = self.rx * t2bb
-        t2bbx = t2bb * x
-        tx = x
-
-        d1 = round(t2bbx * (x - 1) + tbb / 2 + t2aa * (1 - tbb))
-
-        while t2bb * tx > t2aa * y:
-            draw4(ret, self.cx, self.cy, x, y)
+        x, y, tx = a, 0, a
+        d1 = self.roundHalf(4 * bb * a * a - 4 * bb * a + bb + 4 * aa - 4 * aa * bb)
+        while bb * tx > aa * y:
+            ret.append((x, y))
             if d1 < 0:
                 y += 1
-                d1 += (t4aa * y + t2aa)
+                d1 += 4 * aa * y + 2 * aa
                 tx = x - 1
             else:
                 x -= 1
                 y += 1
-                d1 = d1 - t4bb * x + t4aa * y + t2aa
+                d1 = d1 - 4 * bb * x + 4 * aa * y + 2 * aa
                 tx = x
-
-        d2 = round(t2bb * (x ** 2 + 1) - t4bb * x +
-                   t2aa * (y ** 2 + y - tbb) + taa / 2)
-
+        d2 = self.roundHalf(4 * bb * (x - 1) ** 2 + aa * (2 * y + 1) ** 2 - 4 * aa * bb)
         while x >= 0:
-            draw4(ret, self.cx, self.cy, x, y)
+            ret.append((x, y))
             if d2 < 0:
                 x -= 1
                 y += 1
-                d2 += (t4aa * y - t4bb * x + t2bb)
+                d2 += 4 * aa * y - 4 * bb * x + 2 * bb
             else:
                 x -= 1
-                d2 = d2 - t4bb * x + t2bb
-
+                d2 = d2 - 4 * bb * x + 2 * bb
+        return np.array(ret, np.int64).reshape(-1, 2)
+
+    def quadrant(self) -> np.ndarray:
+        if 4 * self.rx * self.rx * self.ry * self.ry >= self.INT64_LIMIT:
+            return self.quadrantScalar()
+        # Midpoint algorithm for the first quadrant, solved per row (region 1)
+        # and per column (region 2) instead of stepping. Each decision variable
+        # is 2F at a midpoint plus the constant offset introduced by rounding
+        # its initial value, so the closed forms below pick the same pixels.
+        a, b = self.rx, self.ry
+        aa, bb = a * a, b * b
+
+        xs1 = ys1 = np.empty(0, np.int64)
+        xe, ye = a, 0
+        if bb * a > 0:
+            v0 = 4 * bb * a * a - 4 * bb * a + bb + 4 * aa - 4 * aa * bb
+            e1 = 2 * self.roundHalf(v0) - v0
+            ylim = b + 2
+            while True:
+                y = np.arange(ylim + 1, dtype=np.int64)
+                g = self.largestBelow(bb, 4 * aa * bb - 4 * aa * y[1:] ** 2 - e1)
+                # x steps down by at most one per row: x(y) = max(x(y-1) - 1, g(y))
+                x = np.maximum.accumulate(np.concatenate(([a], g + y[1:]))) - y
+                tx = np.concatenate(([a], np.where(x[1:] == x[:-1], x[1:] - 1, x[1:])))
+                stop = np.flatnonzero(bb * tx <= aa * y)
+                if len(stop):
+                    break
+                ylim *= 2
+            ye = int(stop[0])
+            xe = int(x[ye])
+            xs1, ys1 = x[:ye], y[:ye]
+
+        xs2 = ys2 = np.empty(0, np.int64)
+        if xe >= 0:
+            v2 = 4 * bb * (xe - 1) ** 2 + aa * (2 * ye + 1) ** 2 - 4 * aa * bb
+            e2 = 2 * self.roundHalf(v2) - v2
+            xs2 = np.arange(xe, -1, -1, dtype=np.int64)
+            t = np.arange(len(xs2), dtype=np.int64)
+            h = np.full(len(xs2) - 1, self.NONE, np.int64)
+            if aa > 0:
+                h = self.largestBelow(aa, 4 * aa * bb - 4 * bb * xs2[1:] ** 2 - e2)
+            # y steps up by at most one per column: y(t) = min(y(t-1) + 1, h(t))
+            ys2 = np.minimum.accumulate(np.concatenate(([ye], np.maximum(h, ye) - t[1:]))) + t
+
+        return np.stack((np.concatenate((xs1, xs2)), np.concatenate((ys1, ys2))), axis=1)
+
+    def _render(self) -> np.ndarray:
+        q = self.quadrant()
+        x, y = q[:, 0], q[:, 1]
+        mx, my, mxy = x > 0, y > 0, (x > 0) & (y > 0)
+        ret = np.empty((len(q) + mx.sum() + my.sum() + mxy.sum(), 2), np.int32)
+        ret[:, 0] = self.cx + np.concatenate((x, x[my], -x[mx], -x[mxy]))
+        ret[:, 1] = self.cy + np.concatenate((y, -y[my], y[mx], -y[mxy]))
         return ret
 
-    def _translate(self, dx: int, dy: int) -> None:
-        self.cx, self.cy = self.translatePoint(self.cx, self.cy, dx, dy)
-
-    def _rotate(self, x: int, y: int, r: int) -> None:
-        self.cx, self.cy = self.rotatePoint(self.cx, self.cy, x, y, r)
-
-    def _scale(self, x: int, y: int, s: float) -> None:
-        self.cx, self.cy = self.scalePoint(self.cx, self.cy, x, y, s)
+    def _transform(self, m: np.ndarray) -> None:
+        # ellipses are not rotated, only their center moves and the radii
+        # follow the (uniform) scale factor of the transform
+        (self.cx, self.cy), = self.transformPoints(m, [(self.cx, self.cy)])
+        s = sqrt(abs(m[0, 0] * m[1, 1] - m[0, 1] * m[1, 0]))
         self.rx = round(self.rx * s)
         self.ry = round(self.ry * s)
 
-    def __str__(self):
+    def _str(self):
         return f"Ellipse ({self.cx}\u00B1{self.rx}, {self.cy}\u00B1{self.ry})"
 
 
@@ -463,6 +979,9 @@ class Curve(Primitive):
         Bezier = 1
         B_spline = 2
 
+    BEZIER_EXACT_DEGREE = 64
+    SAMPLE_CHUNK = 1 << 22
+
     def __init__(self, points: List[Point], algorithm: Algorithm):
         super().__init__(Primitive.PType.curve)
         if len(points) <= 1:
@@ -470,113 +989,109 @@ class Curve(Primitive):
         self.points = points
         self.algorithm = algorithm
 
-    def boundingRect(self):
-        x = []
-        y = []
-        for p in self.render():
-            x.append(p[0])
-            y.append(p[1])
-        return min(x)-1, min(y)-1, max(x)-min(x)+2, max(y)-min(y)+2
+    def controlPoints(self) -> List[Point]:
+        return self.points
+
+    def _boundingRect(self):
+        pixels = self.render()
+        x0, y0 = pixels.min(axis=0).tolist()
+        x1, y1 = pixels.max(axis=0).tolist()
+        return x0-1, y0-1, x1-x0+2, y1-y0+2
+
+    @staticmethod
+    def bezierExact(points: np.ndarray, u: np.ndarray) -> np.ndarray:
+        # same operation order as the textbook sum, for bit-identical results
+        n = len(points)
+        base = np.array([factorial(n-1) / (factorial(i) * factorial(n-1-i)) for i in range(n)])
+        weighted = base[:, None] * points
+        v = 1 - u
+        ret = np.zeros((len(u), 2))
+        for i in range(n):
+            ret += weighted[i] * (u ** i)[:, None] * (v ** (n-1-i))[:, None]
+        return ret
 
-    def render_Bezier(self, points) -> List[Point]:
+    @staticmethod
+    def bezierStable(points: np.ndarray, u: np.ndarray) -> np.ndarray:
+        # Bernstein weights evaluated in log space, which neither overflows in
+        # the binomials nor underflows in the powers. The weights follow a
+        # binomial distribution around u * (n-1), so only a window of about
+        # ten standard deviations on each side contributes anything.
+        n = len(points)
+        half = int(np.ceil(5 * np.sqrt(n))) + 1
+        width = min(n, 2 * half + 1)
+        first = np.clip(np.rint(u * (n-1)).astype(np.int64) - half, 0, n - width)
+        i = first[:, None] + np.arange(width)
+
+        lnfact = np.concatenate(([0.0], np.cumsum(np.log(np.arange(1, n)))))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            lnu = np.where(i > 0, np.log(u)[:, None] * i, 0)
+            lnv = np.where(i < n-1, np.log1p(-u)[:, None] * (n-1-i), 0)
+        weights = np.exp(lnfact[-1] - lnfact[i] - lnfact[n-1-i] + lnu + lnv)
+        return np.einsum("sw,swk->sk", weights, points[i])
+
+    def render_Bezier(self, points) -> np.ndarray:
+        points = np.asarray(points, np.int64)
         npoints = len(points)
-        xs = [0] * npoints
-        ys = [0] * npoints
-        facts = [1] * (npoints)
-        for i in range(1, npoints):
-            facts[i] = facts[i-1] * i
-
-        for i in range(npoints):
-            base = facts[npoints-1] / (facts[i] * facts[npoints-1-i])
-            xs[i] = base * points[i][0]
-            ys[i] = base * points[i][1]
-
-        steps = 1
-
-        for i in range(npoints-1):
-            dx = abs(points[i+1][0]-points[i][0])
-            dy = abs(points[i+1][1]-points[i][1])
-            steps += round((dx + dy) * 3)
-
-        ret = []
-        for s in range(steps+1):
-            u = s / steps
-            x = 0
-            y = 0
-            for i in range(npoints):
-                x += xs[i] * (u ** i) * ((1-u) ** (npoints-1-i))
-                y += ys[i] * (u ** i) * ((1-u) ** (npoints-1-i))
-            ret.append((round(x), round(y)))
+        steps = 1 + int(np.sum(np.abs(np.diff(points, axis=0)).sum(axis=1) * 3))
+
+        u = np.arange(steps + 1) / steps
+        ret = np.empty((steps + 1, 2), np.int32)
+        chunk = max(1, self.SAMPLE_CHUNK // min(npoints, 12 * int(np.sqrt(npoints)) + 3))
+        for start in range(0, steps + 1, chunk):
+            us = u[start:start+chunk]
+            if npoints <= self.BEZIER_EXACT_DEGREE:
+                ps = self.bezierExact(points, us)
+            else:
+                ps = self.bezierStable(points, us)
+            ret[start:start+chunk] = np.rint(ps)
 
         return ret
 
-    def render_B_spline(self) -> List[Point]:
-        def b(i: int, t: float):
-            if i == -2:
-                return (((-t + 3) * t - 3) * t + 1) / 6
-            elif i == -1:
-                return (((3 * t - 6) * t) * t + 4) / 6
-            elif i == 0:
-                return (((-3 * t + 3) * t + 3) * t + 1) / 6
-            elif i == 1:
-                return (t * t * t) / 6
-            return 0
-
-        def point(i: int, t: float, xps, yps):
-            px = 0
-            py = 0
-            for j in range(-2, 2):
-                px += b(j, t)*xps[i+j]
-                py += b(j, t)*yps[i+j]
-            return (round(px), round(py))
+    @staticmethod
+    @lru_cache(maxsize=64)
+    def bsplineBasis(steps: int) -> np.ndarray:
+        t = np.arange(steps + 1) / steps
+        ret = np.empty((steps + 1, 4))
+        ret[:, 0] = (((-t + 3) * t - 3) * t + 1) / 6
+        ret[:, 1] = (((3 * t - 6) * t) * t + 4) / 6
+        ret[:, 2] = (((-3 * t + 3) * t + 3) * t + 1) / 6
+        ret[:, 3] = (t * t * t) / 6
+        ret.flags.writeable = False
+        return ret
 
+    def render_B_spline(self) -> np.ndarray:
         if len(self.points) < 4:
             return self.render_Bezier(self.points)
 
-        points = self.points
-        npoints = len(points) - 1
-        steps = 1
-        for i in range(npoints):
-            dx = abs(points[i+1][0]-points[i][0])
-            dy = abs(points[i+1][1]-points[i][1])
-            steps = max(round(dx + dy) * 3, steps)
-        pts = npoints * steps + 1
-        ret = []
-
-        xs = [_[0] for _ in points]
-        ys = [_[1] for _ in points]
-
-        ret.append(point(2, 0, xs, ys))
-        for i in range(2, npoints):
-            for j in range(1, steps+1):
-                ret.append(
-                    point(i, j/steps, xs, ys)
-                )
+        points = np.asarray(self.points, np.int64)
+        steps = max(1, int(np.abs(np.diff(points, axis=0)).sum(axis=1).max()) * 3)
+        basis = self.bsplineBasis(steps)
+
+        # row j of segment s is sum_k basis[j, k] * points[s+k]; the four
+        # terms are accumulated in order so every sample rounds the same way
+        nsegments = len(points) - 3
+        ret = np.empty((nsegments * steps + 1, 2), np.int32)
+        ret[0] = np.rint(sum(basis[0, k] * points[k] for k in range(4)))
+        chunk = max(1, self.SAMPLE_CHUNK // (steps + 1))
+        for start in range(0, nsegments, chunk):
+            segments = np.arange(start, min(start + chunk, nsegments))
+            ps = np.zeros((len(segments), steps, 2))
+            for k in range(4):
+                ps += basis[1:, k, None] * points[segments + k][:, None, :]
+            ret[1 + start*steps:1 + (start+len(segments))*steps] = np.rint(ps).reshape(-1, 2)
 
         return ret
 
-    def _render(self) -> List[Point]:
+    def _render(self) -> np.ndarray:
         if self.algorithm == self.Algorithm.Bezier:
-            return self.render_Bezier(self.points)
+            return self.toPixels(self.render_Bezier(self.points))
         elif self.algorithm == self.Algorithm.B_spline:
-            return self.render_B_spline()
+            return self.toPixels(self.render_B_spline())
         else:
             raise TypeError("Invalid curve algorithm")
 
-    def _translate(self, dx: int, dy: int) -> None:
-        for i in range(len(self.points)):
-            self.points[i] = self.translatePoint(
-                self.points[i][0], self.points[i][1], dx, dy)
+    def _transform(self, m: np.ndarray) -> None:
+        self.points = self.transformPoints(m, self.points)
 
-    def _rotate(self, x: int, y: int, r: int) -> None:
-        for i in range(len(self.points)):
-            self.points[i] = self.rotatePoint(
-                self.points[i][0], self.points[i][1], x, y, r)
-
-    def _scale(self, x: int, y: int, s: float) -> None:
-        for i in range(len(self.points)):
-            self.points[i] = self.scalePoint(
-                self.points[i][0], self.points[i][1], x, y, s)
-
-    def __str__(self):
+    def _str(self):
         return f"Curve ({self.points[0][0]}, {self.points[0][1]})\u2192({self.points[-1][0]}, {self.points[-1][1]})"
@@ -0,0 +1,272 @@
+from cg_algorithms import *
+from cg_cli import Board
+import sys
+import os
+import json
+import time
+import random
+import platform
+import argparse
+import filecmp
+import tempfile
+import subprocess
+from typing import Callable, Dict
+import numpy as np
+
+# Synthetic workloads: each generator returns the lines of a command script,
+# so the same workload feeds the primitive, Board and CLI benchmarks.
+
+SIZE = 1000
+
+
+def point(rng: random.Random, margin: int = 0) -> str:
+    return "{} {}".format(rng.randint(-margin, SIZE + margin), rng.randint(-margin, SIZE + margin))
+
+
+def randomLines(n: int, algorithm: str, seed: int = 0) -> List[str]:
+    rng = random.Random(seed)
+    return ["drawLine l{} {} {} {}".format(i, point(rng), point(rng), algorithm) for i in range(n)]
+
+
+def randomPolygons(n: int, vertices: int, command: str = "drawPolygon", seed: int = 0) -> List[str]:
+    rng = random.Random(seed)
+    return [
+        "{} p{} {} Bresenham".format(command, i, " ".join(point(rng) for _ in range(vertices)))
+        for i in range(n)
+    ]
+
+
+def randomEllipses(n: int, radius: int, seed: int = 0) -> List[str]:
+    rng = random.Random(seed)
+    script = []
+    for i in range(n):
+        cx, cy = rng.randint(0, SIZE), rng.randint(0, SIZE)
+        rx, ry = rng.randint(radius // 2, radius), rng.randint(radius // 2, radius)
+        script.append("drawEllipse e{} {} {} {} {}".format(i, cx - rx, cy - ry, cx + rx, cy + ry))
+    return script
+
+
+def randomCurves(n: int, degree: int, algorithm: str, seed: int = 0) -> List[str]:
+    rng = random.Random(seed)
+    return [
+        "drawCurve c{} {} {}".format(i, " ".join(point(rng) for _ in range(degree + 1)), algorithm)
+        for i in range(n)
+    ]
+
+
+def clipScript(n: int, windows: int, seed: int = 0) -> List[str]:
+    rng = random.Random(seed)
+    script = ["drawLine l{} {} {} Bresenham".format(i, point(rng, 200), point(rng, 200)) for i in range(n)]
+    for i in range(windows):
+        x0, y0 = rng.randint(0, 400), rng.randint(0, 400)
+        algorithm = "Cohen-Sutherland" if i % 2 else "Liang-Barsky"
+        script += ["clip l{} {} {} {} {} {}".format(j, x0, y0, x0 + 500, y0 + 500, algorithm) for j in range(i, n, windows)]
+    return script
+
+
+def animationScript(n: int, frames: int, seed: int = 0) -> List[str]:
+    rng = random.Random(seed)
+    script = randomLines(n // 2, "Bresenham", seed) + randomEllipses(n // 4, 60, seed) + randomPolygons(n // 4, 6, seed=seed)
+    for f in range(frames):
+        script.append("translate l{} {} {}".format(rng.randrange(n // 2), rng.randint(-20, 20), rng.randint(-20, 20)))
+        script.append("rotate p{} 500 500 {}".format(rng.randrange(n // 4), rng.randint(0, 359)))
+        script.append("saveCanvas f{}".format(f))
+    return script
+
+
+def board(script: List[str]) -> Board:
+    b = Board(SIZE, SIZE)
+    for line in script:
+        b.exec(line)
+    return b
+
+
+def renderedBoard(script: List[str]) -> Board:
+    b = board(script)
+    b.render()
+    return b
+
+
+def primitives(script: List[str]) -> List[Primitive]:
+    return [p for p, _ in board(script).primitives.values()]
+
+
+def timeit(run: Callable[[], None], setup: Callable[[], object] = None, repeat: int = 3) -> float:
+    # best of `repeat`, each on fresh state from setup()
+    best = None
+    for _ in range(repeat):
+        state = setup() if setup else None
+        Primitive.shapeCache.clear()
+        start = time.perf_counter()
+        if setup:
+            run(state)
+        else:
+            run()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def renderAll(ps: List[Primitive]):
+    for p in ps:
+        p.render()
+        p.spans()
+
+
+def clipAll(ps: List[Primitive], algorithm):
+    for p in ps:
+        p.clip(200, 200, 700, 700, algorithm)
+
+
+def benchAlgorithms(scale: float, repeat: int) -> Dict[str, float]:
+    n = lambda v: max(1, int(v * scale))
+    workloads = {
+        "line.DDA": randomLines(n(5000), "DDA"),
+        "line.Bresenham": randomLines(n(5000), "Bresenham"),
+        "polygon.vertices": randomPolygons(n(20), n(500)),
+        "fillPolygon.vertices": randomPolygons(n(20), n(200), "fillPolygon"),
+        "ellipse.large": randomEllipses(n(200), 450),
+        "curve.Bezier.degree": randomCurves(n(10), n(200), "Bezier"),
+        "curve.B-spline.degree": randomCurves(n(10), n(500), "B-spline"),
+    }
+    results = {}
+    for name, script in workloads.items():
+        results["algorithm." + name] = timeit(renderAll, lambda: primitives(script), repeat)
+
+    lines = primitives(randomLines(n(100000), "Bresenham"))
+    ends = np.array([(l.x0, l.y0, l.x1, l.y1) for l in lines], np.int64)
+    for algorithm in Line.Algorithm:
+        results["algorithm.line.render_batch." + algorithm.name] = timeit(
+            lambda: Line.render_batch(ends[:, 0], ends[:, 1], ends[:, 2], ends[:, 3], algorithm), repeat=repeat)
+    for algorithm in Line.ClipAlgorithm:
+        results["algorithm.line.clip_batch." + algorithm.name] = timeit(
+            lambda: Line.clip_batch(ends[:, 0], ends[:, 1], ends[:, 2], ends[:, 3], 200, 200, 700, 700, algorithm),
+            repeat=repeat)
+        results["algorithm.line.clip." + algorithm.name] = timeit(
+            lambda ps: clipAll(ps, algorithm), lambda: primitives(randomLines(n(20000), "Bresenham")), repeat)
+        results["algorithm.polygon.clip." + algorithm.name] = timeit(
+            lambda ps: clipAll(ps, algorithm), lambda: primitives(randomPolygons(n(200), n(50))), repeat)
+    return results
+
+
+def benchBoard(scale: float, repeat: int) -> Dict[str, float]:
+    n = lambda v: max(1, int(v * scale))
+    script = animationScript(n(4000), 1)[:-1]
+    results = {}
+    results["board.render.full"] = timeit(lambda b: b.render(), lambda: board(script), repeat)
+
+    def incremental(b: Board):
+        for i in range(20):
+            b.translate("l{}".format(i), 3, 3)
+            b.render()
+    results["board.render.incremental"] = timeit(incremental, lambda: renderedBoard(script), repeat)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "frame.bmp")
+        results["board.save"] = timeit(lambda b: b.save(path), lambda: renderedBoard(script), repeat)
+        results["board.clipAll"] = timeit(
+            lambda b: b.clipAll(200, 200, 700, 700, Line.ClipAlgorithm.Liang_Barsky),
+            lambda: board(randomLines(n(50000), "Bresenham")), repeat)
+    return results
+
+
+def benchCLI(scale: float, repeat: int) -> Dict[str, float]:
+    n = lambda v: max(1, int(v * scale))
+    cli = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cg_cli.py")
+    scripts = {
+        "animation": ["resetCanvas {} {}".format(SIZE, SIZE)] + animationScript(n(2000), n(50)),
+        "clip": clipScript(n(20000), 4) + ["saveCanvas clip"],
+        "curves": randomCurves(n(50), 20, "Bezier") + randomCurves(n(50), 20, "B-spline") + ["saveCanvas curves"],
+    }
+    modes = {"": [], ".pipeline": ["--pipeline"], ".frames": ["--frames"]}
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, script in scripts.items():
+            path = os.path.join(tmp, name + ".txt")
+            with open(path, "w") as File:
+                File.write("\n".join(script) + "\n")
+            for mode, flags in modes.items():
+                out = os.path.join(tmp, name + mode)
+                results["cli." + name + mode] = timeit(
+                    lambda: subprocess.run([sys.executable, cli, path, out] + flags, check=True,
+                                           stdout=subprocess.DEVNULL), repeat=repeat)
+            # a faster mode only counts if it writes the same frames
+            expected = os.path.join(tmp, name)
+            for mode in modes:
+                mismatch = differentFrames(expected, os.path.join(tmp, name + mode))
+                if mismatch:
+                    raise RuntimeError("cli.{}{} frames differ from the default mode: {}".format(
+                        name, mode, ", ".join(mismatch)))
+    return results
+
+
+def differentFrames(expected: str, actual: str) -> List[str]:
+    names = sorted(set(os.listdir(expected)) | set(os.listdir(actual)))
+    _, mismatch, errors = filecmp.cmpfiles(expected, actual, names, shallow=False)
+    return mismatch + errors
+
+
+SUITES = {
+    "algorithms": benchAlgorithms,
+    "board": benchBoard,
+    "cli": benchCLI,
+}
+
+
+def compare(results: Dict[str, float], baseline: Dict[str, float], tolerance: float) -> List[str]:
+    regressions = []
+    print("{:45} {:>10} {:>10} {:>8}".format("benchmark", "baseline", "current", "ratio"))
+    for name, seconds in results.items():
+        old = baseline.get(name)
+        if old is None:
+            print("{:45} {:>10} {:10.4f}".format(name, "-", seconds))
+            continue
+        ratio = seconds / old if old > 0 else float("inf")
+        flag = ""
+        if ratio > 1 + tolerance:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print("{:45} {:10.4f} {:10.4f} {:8.2f}{}".format(name, old, seconds, ratio, flag))
+    return regressions
+
+
+def parseArgs(args: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the algorithms, Board and the CLI.")
+    parser.add_argument("--suite", choices=list(SUITES), action="append",
+                        help="suite to run, may be repeated (default: all)")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplier for workload sizes")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per benchmark, the best is kept")
+    parser.add_argument("--output", help="write results as JSON")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed slowdown over the baseline before failing (0.2 = 20%%)")
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    args = parseArgs(sys.argv[1:])
+    results: Dict[str, float] = {}
+    for suite in args.suite or list(SUITES):
+        results.update(SUITES[suite](args.scale, args.repeat))
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "scale": args.scale,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as File:
+            json.dump(report, File, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "r") as File:
+            baseline = json.load(File)["results"]
+        sys.exit(1 if compare(results, baseline, args.tolerance) else 0)
+    for name, seconds in results.items():
+        print("{:45} {:10.4f}".format(name, seconds))
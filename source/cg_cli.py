@@ -1,12 +1,165 @@
 from cg_algorithms import *
+from cg_scene import Scene, writeScene
+from cg_profile import Profiler
+from cg_image import bmpHeader, bmpRowBytes, writeImage
 import sys
 import os
-from typing import Dict
+import argparse
+import queue
+import threading
+import time
+import pickle
+import atexit
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, FrozenSet, Iterator, List, Set, Tuple
 import numpy as np
 from PIL import Image
 
 
+Rect = Tuple[int, int, int, int]
+
+
+def overlaps(a: Rect, b: Rect) -> bool:
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+# Uniform grid over inclusive rectangles. Rectangles covering more than
+# MAX_CELLS cells are kept in a separate list that every query checks.
+class GridIndex():
+    CELL = 64
+    MAX_CELLS = 1024
+
+    def __init__(self):
+        self.rects: Dict[str, Rect] = {}
+        self.cells: Dict[Tuple[int, int], Set[str]] = {}
+        self.large: Set[str] = set()
+
+    def __len__(self):
+        return len(self.rects)
+
+    def cellRange(self, rect: Rect):
+        return range(rect[0] // self.CELL, rect[2] // self.CELL + 1), range(rect[1] // self.CELL, rect[3] // self.CELL + 1)
+
+    def insert(self, id: str, rect: Rect):
+        self.remove(id)
+        self.rects[id] = rect
+        xs, ys = self.cellRange(rect)
+        if len(xs) * len(ys) > self.MAX_CELLS:
+            self.large.add(id)
+            return
+        for cx in xs:
+            for cy in ys:
+                self.cells.setdefault((cx, cy), set()).add(id)
+
+    def remove(self, id: str):
+        rect = self.rects.pop(id, None)
+        if rect is None:
+            return
+        if id in self.large:
+            self.large.discard(id)
+            return
+        xs, ys = self.cellRange(rect)
+        for cx in xs:
+            for cy in ys:
+                cell = self.cells[(cx, cy)]
+                cell.discard(id)
+                if not cell:
+                    del self.cells[(cx, cy)]
+
+    def query(self, rect: Rect) -> Set[str]:
+        xs, ys = self.cellRange(rect)
+        found = set(self.large)
+        if len(xs) * len(ys) > len(self.cells):
+            for (cx, cy), cell in self.cells.items():
+                if cx in xs and cy in ys:
+                    found |= cell
+        else:
+            for cx in xs:
+                for cy in ys:
+                    cell = self.cells.get((cx, cy))
+                    if cell:
+                        found |= cell
+        return {id for id in found if overlaps(self.rects[id], rect)}
+
+
+# A named node of the scene graph: ids of primitives and nested groups, and
+# one transform shared by all of them, None for identity. Groups are replaced
+# rather than changed, so the undo history can keep old ones.
+class Group():
+    def __init__(self, members: FrozenSet[str] = frozenset(), matrix: np.ndarray = None):
+        self.members = members
+        self.matrix = matrix
+
+
+def compose(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    # a @ b where None is the identity
+    if a is None:
+        return b
+    return a if b is None else a @ b
+
+
+def inverse(m: np.ndarray) -> np.ndarray:
+    return None if m is None else np.linalg.inv(m)
+
+
+# Undo/redo over entries keyed by id. snapshot() opens an empty change set
+# and the first write to an id after it saves the id's previous entry, so a
+# snapshot is O(1) and each change set only holds what actually changed.
+class History():
+    LIMIT = 1000
+
+    def __init__(self):
+        self.undos: List[Dict[str, object]] = []
+        self.redos: List[Dict[str, object]] = []
+
+    def snapshot(self):
+        self.undos.append({})
+        self.redos = []
+        if len(self.undos) > self.LIMIT:
+            del self.undos[0]
+
+    def record(self, id: str, entry) -> bool:
+        # every write makes the undone steps stale; True on the first write
+        # to id since the last snapshot, which is when entry is kept
+        if self.redos:
+            self.redos = []
+        if not self.undos or id in self.undos[-1]:
+            return False
+        self.undos[-1][id] = entry
+        return True
+
+    @staticmethod
+    def step(source: List[Dict[str, object]], target: List[Dict[str, object]], current, restore) -> List[str]:
+        if not source:
+            return []
+        changes = source.pop()
+        target.append({id: current(id) for id in changes})
+        for id, entry in changes.items():
+            restore(id, entry)
+        return list(changes)
+
+    def undo(self, current, restore) -> List[str]:
+        return self.step(self.undos, self.redos, current, restore)
+
+    def redo(self, current, restore) -> List[str]:
+        return self.step(self.redos, self.undos, current, restore)
+
+
 class Board():
+    MAX_REGIONS = 8
+    # dirty regions are cut into TILE x TILE tiles painted on a thread pool
+    TILE = 512
+    THREADS = os.cpu_count() or 1
+    tilePool: ThreadPoolExecutor = None
+    # canvases above LARGE_CANVAS bytes are kept in a memmap, and BMP frames
+    # are rendered and written STRIP rows at a time
+    LARGE_CANVAS = 1 << 28
+    STRIP = 256
+    # file extension used by saveCanvas
+    FORMAT = "bmp"
+
     def __init__(self, width: int, height: int, output_dir: str = ""):
         if height <= 0 or width <= 0:
             raise ValueError("Board size should be greater to 0")
@@ -16,6 +169,37 @@ class Board():
         self.primitives: Dict[str, (Primitive, Color)] = {}
         self.output_dir = output_dir
 
+        # persistent canvas, repainted only inside dirty regions
+        self.canvas: np.ndarray = None
+        self.painted: Dict[str, Rect] = {}
+        self.changed: Set[str] = set()
+        self.dirty: List[Rect] = []
+
+        # bounds of every primitive, refreshed lazily for the ids in stale
+        self.index = GridIndex()
+        self.stale: Set[str] = set()
+        self.rank: Dict[str, int] = {}
+        self.nextRank = 0
+
+        # Groups share one id namespace with primitives. A primitive is drawn
+        # with the transforms of its groups composed over its own geometry;
+        # those placed copies are cached until the primitive or a group above
+        # it changes. Commands always take canvas coordinates.
+        self.groups: Dict[str, Group] = {}
+        self.parent: Dict[str, str] = {}
+        self.placed: Dict[str, Primitive] = {}
+        self.moved: Set[str] = set()
+
+        # change sets of (primitive, color, rank) or Group entries, None
+        # when absent
+        self.history = History()
+        self.reorder = False
+
+        # when set, save(path) calls sink(path) instead of writing the image
+        self.sink = None
+        # optional Profiler collecting command, raster and encode timings
+        self.profiler: Profiler = None
+
     def setColor(self, color: Color):
         self.color = color
 
@@ -23,52 +207,455 @@ class Board():
         return self.color
 
     def reset(self, width: int, height: int):
+        sink, profiler = self.sink, self.profiler
         self.__init__(width, height, self.output_dir)
+        self.sink, self.profiler = sink, profiler
+
+    @staticmethod
+    def extent(primitive: Primitive) -> Rect:
+        pixels = primitive.render()
+        spans = primitive.spans()
+        x = [pixels[:, 0].min(), pixels[:, 0].max()] if len(pixels) else []
+        y = [pixels[:, 1].min(), pixels[:, 1].max()] if len(pixels) else []
+        if len(spans):
+            x += [spans[:, 1].min(), spans[:, 2].max()]
+            y += [spans[:, 0].min(), spans[:, 0].max()]
+        if not x:
+            return None
+        return int(min(x)), int(min(y)), int(max(x)), int(max(y))
+
+    overlaps = staticmethod(overlaps)
+
+    @staticmethod
+    def union(a: Rect, b: Rect) -> Rect:
+        return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
+    def mergeRegions(self, regions: List[Rect]) -> List[Rect]:
+        ret: List[Rect] = []
+        for r in regions:
+            r = max(r[0], 0), max(r[1], 0), min(r[2], self.width-1), min(r[3], self.height-1)
+            if r[0] > r[2] or r[1] > r[3]:
+                continue
+            merged = True
+            while merged:
+                merged = False
+                for i in range(len(ret)):
+                    if self.overlaps(ret[i], r):
+                        r = self.union(ret.pop(i), r)
+                        merged = True
+                        break
+            ret.append(r)
+        if len(ret) > self.MAX_REGIONS:
+            r = ret[0]
+            for other in ret[1:]:
+                r = self.union(r, other)
+            ret = [r]
+        return ret
+
+    @staticmethod
+    def regionPixels(primitive: Primitive, region: Rect) -> np.ndarray:
+        rx0, ry0, rx1, ry1 = region
+        pixels = primitive.render()
+        inside = (pixels[:, 0] >= rx0) & (pixels[:, 0] <= rx1) & (pixels[:, 1] >= ry0) & (pixels[:, 1] <= ry1)
+        return pixels[inside]
+
+    @staticmethod
+    def regionSpans(primitive: Primitive, region: Rect) -> List[Tuple[int, int, int]]:
+        rx0, ry0, rx1, ry1 = region
+        spans = primitive.spans()
+        if not len(spans):
+            return []
+        spans = spans[(spans[:, 0] >= ry0) & (spans[:, 0] <= ry1) & (spans[:, 2] >= rx0) & (spans[:, 1] <= rx1)]
+        return np.stack((spans[:, 0], np.maximum(spans[:, 1], rx0), np.minimum(spans[:, 2], rx1)), 1).tolist()
+
+    def paint(self, rows: np.ndarray, primitives: List[Primitive], color: Color, region: Rect, y0: int = 0):
+        # rows[y - y0, x] is pixel (x, y); outline pixels of one color are
+        # scattered in a single assignment, fill spans are written as row
+        # slices. Everything here has one color, so the order is free.
+        pixels = np.concatenate([self.regionPixels(p, region) for p in primitives])
+        rows[pixels[:, 1] - y0, pixels[:, 0]] = color
+        for p in primitives:
+            for y, x0, x1 in self.regionSpans(p, region):
+                rows[y - y0, x0:x1 + 1] = color
+
+    def isLarge(self) -> bool:
+        return self.width * self.height * 3 > self.LARGE_CANVAS
+
+    def allocate(self) -> np.ndarray:
+        shape = (self.height, self.width, 3)
+        if self.isLarge():
+            return np.memmap(tempfile.TemporaryFile(), np.uint8, "w+", shape=shape)
+        return np.zeros(shape, np.uint8)
 
     def render(self):
-        canvas = np.zeros([self.height, self.width, 3], np.uint8)
-        canvas.fill(255)
-        for primitive, color in self.primitives.values():
-            for p in primitive.render():
-                if p[0] >= 0 and p[0] < self.width and p[1] >= 0 and p[1] < self.height:
-                    canvas[self.height-p[1]-1][p[0]] = color
-        return canvas
+        # The canvas is kept between calls. Changed and removed primitives
+        # leave dirty regions (where they were painted and where they are
+        # now), and only those regions are cleared and repainted in order.
+        # The returned array is reused by the next call.
+        start = time.perf_counter()
+        self.settleGroups()
+        if self.canvas is None:
+            self.canvas = self.allocate()
+            self.painted = {}
+            self.changed = set(self.primitives)
+            self.dirty = [(0, 0, self.width-1, self.height-1)]
+
+        regions = self.dirty
+        for id in self.changed:
+            old = self.painted.pop(id, None)
+            if old:
+                regions.append(old)
+            if id in self.primitives:
+                rasterStart = time.perf_counter()
+                p = self.placement(id)
+                new = self.extent(p)
+                if self.profiler:
+                    algorithm = p.algorithm.name if hasattr(p, "algorithm") else p.type.name
+                    self.profiler.raster(id, algorithm, rasterStart, time.perf_counter(), len(p.render()) + len(p.spans()))
+                if new:
+                    self.painted[id] = new
+                    regions.append(new)
+        self.changed = set()
+        self.dirty = []
+
+        # Tiles do not overlap and each is painted in draw order, so the
+        # result does not depend on how tiles are scheduled. Every primitive
+        # was rasterized above, so workers only read cached pixels.
+        jobs = [(tile, self.query(*tile)) for region in self.mergeRegions(regions) for tile in self.tiles(region)]
+        if len(jobs) > 1 and self.THREADS > 1:
+            if Board.tilePool is None:
+                Board.tilePool = ThreadPoolExecutor(self.THREADS)
+            list(Board.tilePool.map(lambda job: self.paintRegion(*job), jobs))
+        else:
+            for job in jobs:
+                self.paintRegion(*job)
+        if self.profiler:
+            self.profiler.record("board", "render", start, time.perf_counter(), tiles=len(jobs))
+        return self.canvas
+
+    def tiles(self, region: Rect) -> List[Rect]:
+        x0, y0, x1, y1 = region
+        return [
+            (tx, ty, min(tx + self.TILE - 1, x1), min(ty + self.TILE - 1, y1))
+            for ty in range(y0, y1 + 1, self.TILE)
+            for tx in range(x0, x1 + 1, self.TILE)
+        ]
+
+    def paintRegion(self, region: Rect, ids: List[str]):
+        x0, y0, x1, y1 = region
+        self.canvas[self.height-y1-1:self.height-y0, x0:x1+1] = 255
+        batch, batchColor = [], None
+        for id in ids:
+            primitive, color = self.placement(id), self.primitives[id][1]
+            box = self.painted.get(id)
+            if box and self.overlaps(box, region):
+                if batch and color != batchColor:
+                    self.paint(self.canvas[::-1], batch, batchColor, region)
+                    batch = []
+                batch.append(primitive)
+                batchColor = color
+        if batch:
+            self.paint(self.canvas[::-1], batch, batchColor, region)
+
+    def touch(self, id: str):
+        if id in self.groups:
+            self.moved.add(id)
+            return
+        self.changed.add(id)
+        self.stale.add(id)
+        self.placed.pop(id, None)
+
+    def settleGroups(self):
+        # a group transform only marks the group; its primitives are marked
+        # here, once, before anything is drawn or queried
+        moved, self.moved = self.moved, set()
+        for name in moved:
+            if name in self.groups:
+                for id in self.leaves(name):
+                    self.touch(id)
+
+    def leaves(self, name: str) -> List[str]:
+        ret = []
+        stack = [name]
+        while stack:
+            g = stack.pop()
+            for id in self.groups[g].members:
+                if self.parent.get(id) != g:
+                    continue
+                if id in self.groups:
+                    stack.append(id)
+                else:
+                    ret.append(id)
+        return ret
+
+    def frame(self, name: str) -> np.ndarray:
+        # composed transform of group name and the groups above it
+        m = None
+        while name is not None:
+            m = compose(self.groups[name].matrix, m)
+            name = self.parent.get(name)
+        return m
+
+    def placement(self, id: str) -> Primitive:
+        # the primitive as drawn on the canvas
+        if self.moved:
+            self.settleGroups()
+        p = self.primitives[id][0]
+        if id not in self.parent:
+            return p
+        placed = self.placed.get(id)
+        if placed is None:
+            m = self.frame(self.parent[id])
+            if m is None:
+                return p
+            placed = p.clone()
+            placed.transform(m)
+            self.placed[id] = placed
+        return placed
+
+    def items(self) -> Iterator[Tuple[str, Primitive, Color]]:
+        for id, (_, color) in self.primitives.items():
+            yield id, self.placement(id), color
+
+    def refreshIndex(self):
+        self.settleGroups()
+        for id in self.stale:
+            prim = self.primitives.get(id)
+            box = self.placement(id).bounds() if prim else None
+            if box:
+                self.index.insert(id, box)
+            else:
+                self.index.remove(id)
+            if not prim:
+                self.rank.pop(id, None)
+        self.stale = set()
+
+    def query(self, x0: int, y0: int, x1: int, y1: int) -> List[str]:
+        # ids whose bounds meet the rectangle, in draw order
+        self.refreshIndex()
+        rect = min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)
+        return sorted(self.index.query(rect), key=self.rank.__getitem__)
+
+    def entry(self, id: str):
+        if id in self.groups:
+            return self.groups[id]
+        prim = self.primitives.get(id)
+        return (prim[0], prim[1], self.rank[id]) if prim else None
+
+    def keep(self, id: str) -> bool:
+        self.touch(id)
+        return self.history.record(id, self.entry(id))
+
+    def modify(self, id: str):
+        # copy-on-write: the first change after a snapshot leaves the old
+        # primitive to the history and continues on a copy of it
+        prim = self.primitives.get(id)
+        if prim and self.keep(id):
+            prim = (prim[0].clone(), prim[1])
+            self.primitives[id] = prim
+        self.touch(id)
+        return prim
+
+    def restore(self, id: str, entry):
+        if isinstance(entry, Group) or (entry is None and id in self.groups):
+            self.restoreGroup(id, entry)
+            return
+        if entry is None:
+            self.primitives.pop(id, None)
+        else:
+            p, color, rank = entry
+            # the dict is kept in draw order: a primitive brought back from
+            # removal lands at its end, and one removed and drawn again in
+            # the same step sits at the end under a newer rank
+            self.reorder = self.reorder or id not in self.primitives or self.rank.get(id) != rank
+            self.primitives[id] = (p, color)
+            self.rank[id] = rank
+        self.touch(id)
+
+    def restoreGroup(self, name: str, group: Group):
+        # parent links follow the members of the restored group
+        old = self.groups.pop(name, None)
+        for id in old.members if old else ():
+            if self.parent.get(id) == name:
+                del self.parent[id]
+            self.touch(id)
+        if group:
+            self.groups[name] = group
+            for id in group.members:
+                self.parent[id] = name
+                self.touch(id)
+
+    def snapshot(self):
+        self.history.snapshot()
+
+    def undo(self):
+        self.history.undo(self.entry, self.restore)
+        self.restoreOrder()
+
+    def redo(self):
+        self.history.redo(self.entry, self.restore)
+        self.restoreOrder()
+
+    def restoreOrder(self):
+        if self.reorder:
+            self.primitives = dict(sorted(self.primitives.items(), key=lambda kv: self.rank[kv[0]]))
+            self.reorder = False
 
     def addPrimitive(self, id: str, p: Primitive):
+        if id in self.groups:
+            raise ValueError("Id is used by a group: " + id)
+        self.keep(id)
+        if id not in self.primitives:
+            self.rank[id] = self.nextRank
+            self.nextRank += 1
+        # the points are canvas coordinates, so undo the groups of id
+        m = inverse(self.frame(self.parent.get(id)))
+        if m is not None:
+            p.transform(m)
         self.primitives[id] = (p, self.color)
 
     def removePrimitive(self, id: str):
-        try:
+        if id in self.primitives:
+            self.keep(id)
             del self.primitives[id]
-        except KeyError:
-            pass
 
-    def translate(self, id: str, dx: int, dy: int):
-        prim = self.primitives.get(id)
+    def rebase(self, id: str, m: np.ndarray):
+        # multiply m in front of the own transform of a primitive or group
+        group = self.groups.get(id)
+        if group:
+            self.keep(id)
+            self.groups[id] = Group(group.members, compose(m, group.matrix))
+            return
+        prim = self.modify(id)
         if prim:
-            prim[0].translate(dx, dy)
+            prim[0].transform(m)
+
+    def transform(self, id: str, m: np.ndarray):
+        # m is in canvas coordinates; for a node inside groups it is moved
+        # into the frame of its parent. A group costs one matrix product
+        # however many primitives it holds.
+        f = self.frame(self.parent.get(id))
+        self.rebase(id, m if f is None else np.linalg.inv(f) @ m @ f)
+
+    def translate(self, id: str, dx: int, dy: int):
+        self.transform(id, Primitive.translateMatrix(dx, dy))
 
     def rotate(self, id: str, x: int, y: int, r: int) -> None:
-        prim = self.primitives.get(id)
-        if prim:
-            prim[0].rotate(x, y, -r)
+        self.transform(id, Primitive.rotateMatrix(x, y, -r))
 
     def scale(self, id: str, x: int, y: int, s: float) -> None:
-        prim = self.primitives.get(id)
-        if prim:
-            prim[0].scale(x, y, s)
+        self.transform(id, Primitive.scaleMatrix(x, y, s))
+
+    def setMembers(self, name: str, members):
+        self.keep(name)
+        self.groups[name] = Group(frozenset(members), self.groups[name].matrix)
+
+    def group(self, name: str, ids: List[str]):
+        # creates group name or adds to it; ids may be primitives or groups,
+        # and leave the group they were in. Nothing moves on the canvas.
+        if name not in self.groups and (name in self.primitives or name in self.parent):
+            raise ValueError("Id is used by a primitive: " + name)
+        for id in ids:
+            if id not in self.primitives and id not in self.groups:
+                raise ValueError("Unknown id: " + id)
+            g = name
+            while g is not None:
+                if g == id:
+                    raise ValueError("Group can not contain itself: " + id)
+                g = self.parent.get(g)
+        if name not in self.groups:
+            self.keep(name)
+            self.groups[name] = Group()
+        ids = [id for id in dict.fromkeys(ids) if self.parent.get(id) != name]
+        target = inverse(self.frame(name))
+        byParent: Dict[str, List[str]] = {}
+        for id in ids:
+            byParent.setdefault(self.parent.get(id), []).append(id)
+        for old, members in byParent.items():
+            m = compose(target, self.frame(old))
+            if old is not None:
+                self.setMembers(old, self.groups[old].members.difference(members))
+            for id in members:
+                self.parent[id] = name
+                if m is not None:
+                    self.rebase(id, m)
+        self.setMembers(name, self.groups[name].members.union(ids))
+
+    def ungroup(self, name: str):
+        # members move up to the parent of name, keeping their place
+        group = self.groups.get(name)
+        if not group:
+            return
+        up = self.parent.get(name)
+        members = [id for id in group.members if self.parent.get(id) == name]
+        if up is not None:
+            self.setMembers(up, self.groups[up].members.difference([name]).union(members))
+        self.keep(name)
+        del self.groups[name]
+        self.parent.pop(name, None)
+        for id in members:
+            if up is None:
+                del self.parent[id]
+            else:
+                self.parent[id] = up
+            if group.matrix is not None:
+                self.rebase(id, group.matrix)
+
+    def editable(self, id: str) -> Primitive:
+        # a copy of the primitive in canvas coordinates to change and hand
+        # back to store(); the stored primitive itself when it is not moved
+        # by any group
+        f = self.frame(self.parent.get(id))
+        if f is None:
+            return self.modify(id)[0]
+        self.keep(id)
+        p = self.primitives[id][0].clone()
+        p.transform(f)
+        return p
+
+    def store(self, id: str, p: Primitive):
+        f = self.frame(self.parent.get(id))
+        if f is not None:
+            p.transform(np.linalg.inv(f))
+            self.primitives[id] = (p, self.primitives[id][1])
 
     def clip(self, id: str, x0: int, y0: int, x1: int, y1: int, algorithm) -> None:
         prim = self.primitives.get(id)
         if prim:
             op = getattr(prim[0], "clip", None)
             if op:
-                accept = prim[0].clip(x0, y0, x1, y1, algorithm)
-                if not accept:
+                p = self.editable(id)
+                if p.clip(x0, y0, x1, y1, algorithm):
+                    self.store(id, p)
+                else:
                     del self.primitives[id]
 
+    def clipAll(self, x0: int, y0: int, x1: int, y1: int, algorithm) -> None:
+        # lines whose bounds miss the window (widened by the one pixel of
+        # slack in bounds) lie outside it and are dropped without clipping
+        near = set(self.query(min(x0, x1) - 1, min(y0, y1) - 1, max(x0, x1) + 1, max(y0, y1) + 1))
+        ids = [id for id, (p, _) in self.primitives.items() if p.type == Primitive.PType.line]
+        rejected = {id for id in ids if id not in near}
+        ids = [id for id in ids if id in near]
+        for id in rejected:
+            self.keep(id)
+        if ids:
+            lines = [self.editable(id) for id in ids]
+            for l in lines:
+                l.applyTransform()
+            ends = np.array([(l.x0, l.y0, l.x1, l.y1) for l in lines], np.int64)
+            accept, nx0, ny0, nx1, ny1 = Line.clip_batch(
+                ends[:, 0], ends[:, 1], ends[:, 2], ends[:, 3], x0, y0, x1, y1, algorithm)
+
+            for i in np.flatnonzero(accept).tolist():
+                lines[i].setEnds(int(nx0[i]), int(ny0[i]), int(nx1[i]), int(ny1[i]))
+                self.store(ids[i], lines[i])
+            rejected.update(ids[i] for i in np.flatnonzero(~accept).tolist())
+        if rejected:
+            self.primitives = {k: v for k, v in self.primitives.items() if k not in rejected}
+
     def setPrimColor(self, id: str, color: Color):
-        prim = self.primitives.get(id)
+        prim = self.modify(id)
         if prim:
             self.primitives[id] = (prim[0], color)
 
@@ -82,100 +669,452 @@ class Board():
         Image.fromarray(self.render()).show()
 
     def save(self, path: str):
-        Image.fromarray(self.render()).save(path)
+        if self.sink:
+            self.sink(path)
+        elif self.isLarge() and path.lower().endswith(".bmp"):
+            self.saveStrips(path)
+        else:
+            self.encode(self.render(), path)
 
-    def exec(self, cmd: str):
-        argv = cmd.split()
-        argc = len(argv)
-        if argc <= 0:
-            return
-        if argv[0] == "resetCanvas":
-            self.reset(int(argv[1]), int(argv[2]))
-        elif argv[0] == "saveCanvas":
-            if self.output_dir:
-                self.save(os.path.join(self.output_dir, argv[1] + ".bmp"))
-        elif argv[0] == "setColor":
-            self.setColor((
-                int(argv[1]),
-                int(argv[2]),
-                int(argv[3]),
-            ))
-        elif argv[0] == "drawLine":
-            self.addPrimitive(
-                argv[1], Line(
-                    int(argv[2]), int(argv[3]),
-                    int(argv[4]), int(argv[5]),
-                    Line.Algorithm.DDA if argv[6] == "DDA" else Line.Algorithm.Bresenham
-                )
-            )
-        elif argv[0] == "drawPolygon":
-            pn = (argc - 3) // 2
-            ps = []
-            for i in range(pn):
-                ps.append(
-                    (int(argv[i*2+2]), int(argv[i*2+3]))
-                )
-            self.addPrimitive(
-                argv[1], Polygon(
-                    ps,
-                    Line.Algorithm.DDA if argv[-1] == "DDA" else Line.Algorithm.Bresenham
-                )
-            )
-        elif argv[0] == "drawEllipse":
-            self.addPrimitive(
-                argv[1], Ellipse(
-                    int(argv[2]), int(argv[3]),
-                    int(argv[4]), int(argv[5]),
-                )
-            )
-        elif argv[0] == "drawCurve":
-            pn = (argc - 3) // 2
-            ps = []
-            for i in range(pn):
-                ps.append(
-                    (int(argv[i*2+2]), int(argv[i*2+3]))
-                )
-            self.addPrimitive(
-                argv[1], Curve(
-                    ps,
-                    Curve.Algorithm.B_spline if argv[-1] == "B-spline" else Curve.Algorithm.Bezier
-                )
-            )
-        elif argv[0] == "translate":
-            self.translate(
-                argv[1], int(argv[2]), int(argv[3])
-            )
-        elif argv[0] == "rotate":
-            self.rotate(
-                argv[1], int(argv[2]), int(argv[3]), int(argv[4])
-            )
-        elif argv[0] == "scale":
-            self.scale(
-                argv[1], int(argv[2]), int(argv[3]), float(argv[4])
+    def saveStrips(self, path: str):
+        # BMP stores rows bottom-up, which is increasing y, so strips can be
+        # painted in BGR straight into a row buffer and appended to the file
+        # without ever holding the whole canvas.
+        start = time.perf_counter()
+        self.refreshIndex()
+        buckets: List[List[Tuple[Primitive, Color]]] = [[] for _ in range(0, self.height, self.STRIP)]
+        for id, primitive, color in self.items():
+            box = self.index.rects.get(id)
+            if box and box[3] >= 0 and box[1] < self.height:
+                for s in range(max(box[1], 0) // self.STRIP, min(box[3], self.height - 1) // self.STRIP + 1):
+                    buckets[s].append((primitive, color[::-1]))
+
+        rowBytes = bmpRowBytes(self.width)
+        with open(path, "wb") as File:
+            File.write(bmpHeader(self.width, self.height))
+            for s, bucket in enumerate(buckets):
+                y0 = s * self.STRIP
+                y1 = min(y0 + self.STRIP, self.height) - 1
+                strip = np.zeros((y1 - y0 + 1, rowBytes), np.uint8)
+                rows = np.lib.stride_tricks.as_strided(strip, (y1 - y0 + 1, self.width, 3), (rowBytes, 3, 1))
+                rows[:] = 255
+                region = (0, y0, self.width - 1, y1)
+                batch, batchColor = [], None
+                for primitive, color in bucket:
+                    if batch and color != batchColor:
+                        self.paint(rows, batch, batchColor, region, y0)
+                        batch = []
+                    batch.append(primitive)
+                    batchColor = color
+                if batch:
+                    self.paint(rows, batch, batchColor, region, y0)
+                File.write(memoryview(strip))
+        if self.profiler:
+            self.profiler.frame(path, start, time.perf_counter())
+
+    def encode(self, canvas: np.ndarray, path: str):
+        start = time.perf_counter()
+        writeImage(path, canvas)
+        if self.profiler:
+            self.profiler.frame(path, start, time.perf_counter())
+
+    def saveScene(self, path: str):
+        writeScene(path, self.width, self.height, list(self.items()))
+
+    def loadScene(self, path: str):
+        with Scene(path) as scene:
+            self.reset(scene.width, scene.height)
+            for id, p, color in scene.items():
+                self.color = color
+                self.addPrimitive(id, p)
+            self.color = ColorTable.BLACK
+
+    @staticmethod
+    def parsePoints(argv: List[str]) -> List[Point]:
+        # argv is "cmd id x0 y0 x1 y1 ... algorithm"
+        coords = iter(list(map(int, argv[2:2 + (len(argv) - 3) // 2 * 2])))
+        return list(zip(coords, coords))
+
+    @staticmethod
+    def lineAlgorithm(name: str):
+        return Line.Algorithm.DDA if name == "DDA" else Line.Algorithm.Bresenham
+
+    @staticmethod
+    def clipAlgorithm(name: str):
+        return Line.ClipAlgorithm.Cohen_Sutherland if name == "Cohen-Sutherland" else Line.ClipAlgorithm.Liang_Barsky
+
+    def cmdResetCanvas(self, argv: List[str]):
+        self.reset(int(argv[1]), int(argv[2]))
+
+    def cmdSaveCanvas(self, argv: List[str]):
+        if self.output_dir:
+            self.save(os.path.join(self.output_dir, argv[1] + "." + self.FORMAT))
+
+    def cmdSetColor(self, argv: List[str]):
+        self.setColor((
+            int(argv[1]),
+            int(argv[2]),
+            int(argv[3]),
+        ))
+
+    def cmdDrawLine(self, argv: List[str]):
+        self.addPrimitive(
+            argv[1], Line(
+                int(argv[2]), int(argv[3]),
+                int(argv[4]), int(argv[5]),
+                self.lineAlgorithm(argv[6])
             )
-        elif argv[0] == "clip":
-            self.clip(
-                argv[1],
+        )
+
+    def cmdDrawPolygon(self, argv: List[str]):
+        self.addPrimitive(argv[1], Polygon(self.parsePoints(argv), self.lineAlgorithm(argv[-1])))
+
+    def cmdFillPolygon(self, argv: List[str]):
+        self.addPrimitive(argv[1], FilledPolygon(self.parsePoints(argv), self.lineAlgorithm(argv[-1])))
+
+    def cmdDrawEllipse(self, argv: List[str]):
+        self.addPrimitive(
+            argv[1], Ellipse(
                 int(argv[2]), int(argv[3]),
                 int(argv[4]), int(argv[5]),
-                Line.ClipAlgorithm.Cohen_Sutherland if argv[-1] == "Cohen-Sutherland" else Line.ClipAlgorithm.Liang_Barsky
             )
+        )
+
+    def cmdDrawCurve(self, argv: List[str]):
+        self.addPrimitive(
+            argv[1], Curve(
+                self.parsePoints(argv),
+                Curve.Algorithm.B_spline if argv[-1] == "B-spline" else Curve.Algorithm.Bezier
+            )
+        )
+
+    def cmdTranslate(self, argv: List[str]):
+        self.translate(
+            argv[1], int(argv[2]), int(argv[3])
+        )
+
+    def cmdRotate(self, argv: List[str]):
+        self.rotate(
+            argv[1], int(argv[2]), int(argv[3]), int(argv[4])
+        )
+
+    def cmdScale(self, argv: List[str]):
+        self.scale(
+            argv[1], int(argv[2]), int(argv[3]), float(argv[4])
+        )
+
+    def cmdClip(self, argv: List[str]):
+        self.clip(
+            argv[1],
+            int(argv[2]), int(argv[3]),
+            int(argv[4]), int(argv[5]),
+            self.clipAlgorithm(argv[-1])
+        )
+
+    def cmdClipAll(self, argv: List[str]):
+        self.clipAll(
+            int(argv[1]), int(argv[2]),
+            int(argv[3]), int(argv[4]),
+            self.clipAlgorithm(argv[-1])
+        )
+
+    def cmdGroup(self, argv: List[str]):
+        self.group(argv[1], argv[2:])
+
+    def cmdUngroup(self, argv: List[str]):
+        self.ungroup(argv[1])
+
+    def cmdSnapshot(self, argv: List[str]):
+        self.snapshot()
+
+    def cmdUndo(self, argv: List[str]):
+        self.undo()
+
+    def cmdRedo(self, argv: List[str]):
+        self.redo()
+
+    # command name -> handler, filled in below the class
+    COMMANDS = {}
+
+    def exec(self, cmd: str):
+        self.execArgv(cmd.split())
+
+    def execArgv(self, argv: List[str]):
+        if not argv:
+            return
+        handler = self.COMMANDS.get(argv[0])
+        if not handler:
+            return
+        if self.profiler:
+            with self.profiler.timed("command", argv[0]):
+                handler(self, argv)
+        else:
+            handler(self, argv)
+
+    def execFile(self, File):
+        # one line at a time, so memory does not grow with the script
+        for line in File:
+            try:
+                self.exec(line)
+            except Exception as e:
+                print(e)
+
+
+Board.COMMANDS.update({
+    "resetCanvas": Board.cmdResetCanvas,
+    "saveCanvas": Board.cmdSaveCanvas,
+    "setColor": Board.cmdSetColor,
+    "drawLine": Board.cmdDrawLine,
+    "drawPolygon": Board.cmdDrawPolygon,
+    "fillPolygon": Board.cmdFillPolygon,
+    "drawEllipse": Board.cmdDrawEllipse,
+    "drawCurve": Board.cmdDrawCurve,
+    "translate": Board.cmdTranslate,
+    "rotate": Board.cmdRotate,
+    "scale": Board.cmdScale,
+    "clip": Board.cmdClip,
+    "clipAll": Board.cmdClipAll,
+    "group": Board.cmdGroup,
+    "ungroup": Board.cmdUngroup,
+    "snapshot": Board.cmdSnapshot,
+    "undo": Board.cmdUndo,
+    "redo": Board.cmdRedo,
+})
+
+
+# Runs a script as three threads joined by bounded queues: reading and
+# splitting lines, executing commands and rendering frames on the board,
+# and encoding and writing frames. Frames are written one at a time in
+# saveCanvas order, so the output matches Board.execFile.
+class Pipeline():
+    BATCH = 256
+    DONE = None
+
+    def __init__(self, board: Board, depth: int = 4):
+        self.board = board
+        self.commands = queue.Queue(depth)
+        self.frames = queue.Queue(depth)
+
+    def read(self, File):
+        try:
+            batch = []
+            for line in File:
+                batch.append(line.split())
+                if len(batch) >= self.BATCH:
+                    self.commands.put(batch)
+                    batch = []
+            if batch:
+                self.commands.put(batch)
+        except Exception as e:
+            self.commands.put(e)
+        self.commands.put(self.DONE)
+
+    def write(self):
+        while True:
+            frame = self.frames.get()
+            if frame is self.DONE:
+                return
+            path, canvas = frame
+            try:
+                self.board.encode(canvas, path)
+            except Exception as e:
+                print(e)
+
+    def capture(self, path: str):
+        if self.board.isLarge() and path.lower().endswith(".bmp"):
+            # a copy of a large canvas would defeat strip rendering
+            self.board.saveStrips(path)
         else:
-            # invalid
-            pass
+            self.frames.put((path, self.board.render().copy()))
 
+    def run(self, File):
+        reader = threading.Thread(target=self.read, args=(File,), daemon=True)
+        writer = threading.Thread(target=self.write, daemon=True)
+        reader.start()
+        writer.start()
+        self.board.sink = self.capture
+        try:
+            while True:
+                batch = self.commands.get()
+                if batch is self.DONE:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                for argv in batch:
+                    try:
+                        self.board.execArgv(argv)
+                    except Exception as e:
+                        print(e)
+        finally:
+            self.board.sink = None
+            self.frames.put(self.DONE)
+            writer.join()
 
-if __name__ == "__main__":
-    input_file = sys.argv[1]
-    output_dir = sys.argv[2]
-    os.makedirs(output_dir, exist_ok=True)
 
-    # default
-    board = Board(1000, 1000, output_dir)
+def renderFrame(path: str, scene: bytes, largeCanvas: int = Board.LARGE_CANVAS):
+    # settings reach the worker as arguments, spawned workers do not see
+    # changes made to Board in the parent
+    width, height, primitives = pickle.loads(scene)
+    board = Board(width, height)
+    board.LARGE_CANVAS = largeCanvas
+    for i, (p, color) in enumerate(primitives):
+        board.setColor(color)
+        board.addPrimitive(str(i), p)
+    board.save(path)
 
-    with open(input_file, "r") as File:
-        for line in File.readlines():
+
+# Replays the script on one process without rasterizing anything. Each
+# saveCanvas pickles the scene as it is at that point and a worker process
+# renders and writes the frame from scratch. At most `depth` frames per
+# worker are in flight; errors are printed in frame order.
+class FrameParallel():
+    def __init__(self, board: Board, jobs: int = None, depth: int = 2):
+        self.board = board
+        self.jobs = jobs or os.cpu_count() or 1
+        self.limit = self.jobs * depth
+        self.pending = deque()
+
+    def finish(self, limit: int):
+        while len(self.pending) > limit:
             try:
-                board.exec(line)
+                self.pending.popleft().result()
             except Exception as e:
                 print(e)
+
+    def run(self, File):
+        with ProcessPoolExecutor(self.jobs) as pool:
+            def capture(path: str):
+                board = self.board
+                # settle pending transforms the way rendering would, so later
+                # transforms start from the same rounded points
+                primitives = [(p, color) for _, p, color in board.items()]
+                for primitive, _ in primitives:
+                    primitive.applyTransform()
+                scene = pickle.dumps((board.width, board.height, primitives))
+                self.pending.append(pool.submit(renderFrame, path, scene, board.LARGE_CANVAS))
+                self.finish(self.limit)
+
+            self.board.sink = capture
+            try:
+                self.board.execFile(File)
+            finally:
+                self.board.sink = None
+                self.finish(0)
+
+
+def runScript(input_file: str, output_dir: str, pipeline: bool = False, frames: bool = False, jobs: int = None,
+              profiler: Profiler = None, large: bool = False, format: str = "bmp"):
+    with open(input_file, "r") as File:
+        os.makedirs(output_dir, exist_ok=True)
+
+        # default
+        board = Board(1000, 1000, output_dir)
+        board.profiler = profiler
+        if large:
+            board.LARGE_CANVAS = 0
+        board.FORMAT = format.lstrip(".").lower()
+
+        if frames:
+            FrameParallel(board, jobs).run(File)
+        elif pipeline:
+            Pipeline(board).run(File)
+        else:
+            board.execFile(File)
+
+
+def timedScript(input_file: str, output_dir: str, pipeline: bool, large: bool = False,
+                format: str = "bmp") -> Tuple[str, float, str]:
+    start = time.perf_counter()
+    try:
+        runScript(input_file, output_dir, pipeline, large=large, format=format)
+        error = ""
+    except Exception as e:
+        error = "{}: {}".format(type(e).__name__, e)
+    return input_file, time.perf_counter() - start, error
+
+
+def collectScripts(inputs: List[str]) -> List[str]:
+    scripts = []
+    for path in inputs:
+        if os.path.isdir(path):
+            scripts += sorted(
+                os.path.join(path, name) for name in os.listdir(path)
+                if os.path.isfile(os.path.join(path, name))
+            )
+        else:
+            scripts.append(path)
+    return scripts
+
+
+def runBatch(inputs: List[str], output_dir: str, jobs: int = None, pipeline: bool = False, large: bool = False,
+             format: str = "bmp") -> int:
+    # every script gets its own output directory named after the file
+    scripts = collectScripts(inputs)
+    names: Set[str] = set()
+    tasks = []
+    for script in scripts:
+        stem = os.path.splitext(os.path.basename(script))[0]
+        name, n = stem, 1
+        while name in names:
+            n += 1
+            name = "{}_{}".format(stem, n)
+        names.add(name)
+        tasks.append((script, os.path.join(output_dir, name), pipeline, large, format))
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(jobs) as pool:
+        results = list(pool.map(timedScript, *zip(*tasks))) if tasks else []
+    total = time.perf_counter() - start
+
+    failed = [r for r in results if r[2]]
+    for script, seconds, error in results:
+        print("{:8.3f}s  {}{}".format(seconds, script, "  FAILED " + error if error else ""))
+    print("{} scripts, {} failed, {:.3f}s wall, {:.3f}s total".format(
+        len(results), len(failed), total, sum(r[1] for r in results)))
+    return len(failed)
+
+
+def parseArgs(args: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Run drawing command scripts.")
+    parser.add_argument("inputs", nargs="+", metavar="input",
+                        help="script file, or with --batch also directories of scripts")
+    parser.add_argument("output_dir")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="read, render and encode in separate threads")
+    parser.add_argument("--batch", action="store_true",
+                        help="run many scripts in a process pool, each into output_dir/<name>")
+    parser.add_argument("--frames", action="store_true",
+                        help="render and encode saveCanvas frames in a process pool")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="worker processes for --batch or --frames (default: CPU count)")
+    parser.add_argument("--format", default="bmp",
+                        help="image format for saveCanvas: bmp, ppm and raw are written directly, "
+                             "other PIL formats such as png go through PIL (default: bmp)")
+    parser.add_argument("--large", action="store_true",
+                        help="treat every canvas as large: memmap canvas and BMP frames written in strips")
+    parser.add_argument("--profile", action="store_true",
+                        help="print command, raster and encode timings at exit (also CG_PROFILE=1)")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="also write a Chrome trace-event JSON file (also CG_TRACE=FILE)")
+    args = parser.parse_args(args)
+    if not args.batch and len(args.inputs) != 1:
+        parser.error("multiple inputs require --batch")
+    if args.frames and (args.batch or args.pipeline):
+        parser.error("--frames cannot be combined with --batch or --pipeline")
+    return args
+
+
+if __name__ == "__main__":
+    args = parseArgs(sys.argv[1:])
+    if args.batch:
+        sys.exit(1 if runBatch(args.inputs, args.output_dir, args.jobs, args.pipeline, args.large, args.format) else 0)
+    else:
+        trace = args.trace or os.environ.get("CG_TRACE")
+        profiler = Profiler(bool(trace)) if args.profile or args.trace else Profiler.fromEnvironment()
+        if profiler:
+            def report():
+                if trace:
+                    profiler.writeTrace(trace)
+                print(profiler.summary(), file=sys.stderr)
+            atexit.register(report)
+        runScript(args.inputs[0], args.output_dir, args.pipeline, args.frames, args.jobs, profiler, args.large, args.format)
@@ -1,9 +1,11 @@
 from cg_algorithms import *
-from cg_cli import Board
+from cg_cli import Board, History
+from cg_scene import writeScene
 
 import sys
 from enum import Enum
 import math
+from contextlib import contextmanager
 
 from PyQt5.QtCore import (
     Qt,
@@ -45,6 +47,7 @@ from PyQt5.QtGui import (
     QPalette,
     QImage,
     QPixmap,
+    QPolygon,
     QMouseEvent
 )
 
@@ -84,8 +87,9 @@ class Element(QGraphicsItem):
         c = QColor()
         c.setRgb(*self.color)
         painter.setPen(c)
-        for p in self.primitive.render():
-            painter.drawPoint(*p)
+        for y, x0, x1 in self.primitive.spans().tolist():
+            painter.drawLine(x0, y, x1, y)
+        painter.drawPoints(QPolygon(self.primitive.render().ravel().tolist()))
         if self.listItem.isSelected():
             pen = painter.pen()
             c.setAlpha(96)
@@ -112,6 +116,10 @@ class MainCanvas(QGraphicsView):
         self.elements = {}
         self.selecting: Element = None
 
+        # undo/redo of (primitive, color) per element id, None when absent
+        self.history = History()
+        self.batching = False
+
         self.pointList = []
         # self.helperCanvasItems = []
         self.drawingElement: Element = None
@@ -136,20 +144,76 @@ class MainCanvas(QGraphicsView):
         self.main.infoStatusLabel.setText("Selecting: " + items[0].element.__str__())
         self.scene.update(self.scene.sceneRect())
 
+    def entry(self, id: str):
+        e = self.elements.get(id)
+        return (e.primitive, e.color) if e else None
+
+    def change(self, id: str):
+        # every edit is an undo step unless it runs inside batch(); the first
+        # edit of an element in a step leaves its primitive to the history
+        # and continues on a copy
+        if not self.batching:
+            self.history.snapshot()
+        e = self.elements.get(id)
+        if self.history.record(id, self.entry(id)) and e:
+            e.primitive = e.primitive.clone()
+
+    @contextmanager
+    def batch(self):
+        if self.batching:
+            yield
+            return
+        self.history.snapshot()
+        self.batching = True
+        try:
+            yield
+        finally:
+            self.batching = False
+
+    def restore(self, id: str, entry):
+        e = self.elements.get(id)
+        if entry is None:
+            if e:
+                self.removeElement(e)
+            return
+        if e:
+            e.prepareGeometryChange()
+            e.primitive, e.color = entry
+        else:
+            # brought back from removal, it is drawn on top of the others
+            self.insertElement(Element(id, *entry))
+        self.updateElement(id)
+
+    def undo(self):
+        self.history.undo(self.entry, self.restore)
+        self.clearSelection()
+
+    def redo(self):
+        self.history.redo(self.entry, self.restore)
+        self.clearSelection()
+
     def addElement(self, e: Element):
+        self.change(e.id)
+        self.insertElement(e)
+
+    def insertElement(self, e: Element):
         e.canvas = self
         self.elements[e.id] = e
         self.scene.addItem(e)
         self.listWidget.addItem(e.listItem)
 
+    def removeElement(self, e: Element):
+        self.scene.update()
+        self.scene.removeItem(e)
+        self.listWidget.takeItem(self.listWidget.indexFromItem(e.listItem).row())
+        del self.elements[e.id]
+
     def delElement(self, id: str):
         try:
             e = self.elements[id]
+            self.change(id)
             # self.translateElement(id, self.main.size[0]*2, self.main.size[1]*2)
-            self.scene.update()
-            self.scene.removeItem(e)
-            self.listWidget.takeItem(self.listWidget.indexFromItem(e.listItem).row())
-            del self.elements[id]
+            self.removeElement(e)
 
         except Exception as e:
             print(e)
@@ -177,6 +241,7 @@ class MainCanvas(QGraphicsView):
         e = self.getElement(id)
         if not e:
             return
+        self.change(id)
         e.prepareGeometryChange()
         e.primitive.translate(dx, dy)
         self.updateElement(id)
@@ -185,6 +250,7 @@ class MainCanvas(QGraphicsView):
         e = self.getElement(id)
         if not e:
             return
+        self.change(id)
         e.prepareGeometryChange()
         e.primitive.rotate(x0, y0, deg)
         self.updateElement(id)
@@ -193,20 +259,23 @@ class MainCanvas(QGraphicsView):
         e = self.getElement(id)
         if not e:
             return
+        self.change(id)
         e.prepareGeometryChange()
         e.primitive.scale(x0, y0, rate)
         self.updateElement(id)
 
     def clipElement(self, id: str, x0: int, y0: int, x1: int, y1: int, algorithm: Line.ClipAlgorithm):
         e = self.getElement(id)
-        if not e or e.primitive.type != Primitive.PType.line:
+        if not e or e.primitive.type not in [Primitive.PType.line, Primitive.PType.polygon, Primitive.PType.filledPolygon]:
             return
+        self.change(id)
         e.prepareGeometryChange()
 
         if e.primitive.clip(x0, y0, x1, y1, algorithm):
             self.updateElement(id)
         else:
-            self.delElement(id)
+            self.removeElement(e)
+            self.clearSelection()
 
     # def clearHelperCanvasItems(self):
     #     for i in self.helperCanvasItems:
@@ -319,7 +388,7 @@ class MainCanvas(QGraphicsView):
                     self.scaleElement(self.selecting.id, x0, y0, d2/d1)
                     self.main.bScale.toggle()
             elif self.main.acting == Acting.Clip:
-                if self.selecting.primitive.type != Primitive.PType.line:
+                if self.selecting.primitive.type not in [Primitive.PType.line, Primitive.PType.polygon, Primitive.PType.filledPolygon]:
                     self.main.bClip.toggle()
                 if len(self.pointList) >= 2:
                     self.clipElement(
@@ -415,6 +484,20 @@ class MainWindow(QMainWindow):
         saveTXTAction.triggered.connect(self.getSaveTXTDialog)
         fileMenu.addAction(saveTXTAction)
 
+        # Load scene action
+        loadSceneAction = QAction('Load &Scene', self)
+        loadSceneAction.setStatusTip('Load from binary scene file')
+        loadSceneAction.setShortcut('Ctrl+Shift+L')
+        loadSceneAction.triggered.connect(self.getLoadSceneDialog)
+        fileMenu.addAction(loadSceneAction)
+
+        # Save scene action
+        saveSceneAction = QAction('Save S&cene', self)
+        saveSceneAction.setStatusTip('Save the canvas as binary scene file')
+        saveSceneAction.setShortcut('Ctrl+Shift+S')
+        saveSceneAction.triggered.connect(self.getSaveSceneDialog)
+        fileMenu.addAction(saveSceneAction)
+
         # Exit action
         exitAction = QAction('&Exit', self)
         exitAction.setStatusTip('Exit application')
@@ -446,11 +529,15 @@ class MainWindow(QMainWindow):
                 e: Element = self.canvas.elements[k]
                 File.write(f"setColor {e.color[0]} {e.color[1]} {e.color[2]}\n")
                 p: Primitive = e.primitive
+                p.applyTransform()
                 text = ""
                 if p.type == Primitive.PType.line:
                     text = f"drawLine {e.id} {p.x0} {p.y0} {p.x1} {p.y1} {p.algorithm.name}"
-                elif p.type == Primitive.PType.polygon:
-                    text = f"drawPolygon {e.id} "
+                elif p.type in [Primitive.PType.polygon, Primitive.PType.filledPolygon]:
+                    if p.type == Primitive.PType.polygon:
+                        text = f"drawPolygon {e.id} "
+                    else:
+                        text = f"fillPolygon {e.id} "
                     for l in p.lines:
                         text += f"{l.x1} {l.y1} "
                     text += f"{p.algorithm.name}"
@@ -478,15 +565,44 @@ class MainWindow(QMainWindow):
     def loadFileTXT(self, name: str):
         board: Board = Board(1000, 1000)
         with open(name, "r") as File:
-            for line in File.readlines():
-                try:
-                    board.exec(line)
-                except Exception as e:
-                    print(e)
+            board.execFile(File)
+        self.resetSize(board.width, board.height)
+        with self.canvas.batch():
+            for _, p, color in board.items():
+                self.setColor(*color)
+                self.addElement(p)
+
+    def saveFileScene(self, name: str):
+        writeScene(name, self.size[0], self.size[1], [
+            (e.id, e.primitive, e.color) for e in self.canvas.elements.values()
+        ])
+
+    def getSaveSceneDialog(self):
+        fileName = QFileDialog.getSaveFileName(self, "Save Canvas as scene", "output.cgs", "Scenes (*.cgs)")[0]
+        if not fileName:
+            return
+        try:
+            self.saveFileScene(fileName)
+        except Exception as e:
+            print(e)
+
+    def loadFileScene(self, name: str):
+        board: Board = Board(1000, 1000)
+        board.loadScene(name)
         self.resetSize(board.width, board.height)
-        for key in board.primitives:
-            self.setColor(*board.primitives[key][1])
-            self.addElement(board.primitives[key][0])
+        with self.canvas.batch():
+            for _, p, color in board.items():
+                self.setColor(*color)
+                self.addElement(p)
+
+    def getLoadSceneDialog(self):
+        fileName = QFileDialog.getOpenFileName(self, "Load from scene file", "", "Scenes (*.cgs)")[0]
+        if not fileName:
+            return
+        try:
+            self.loadFileScene(fileName)
+        except Exception as e:
+            print(e)
 
     def getLoadTXTDialog(self):
         fileName = QFileDialog.getOpenFileName(self, "Load from text file")[0]
@@ -521,6 +637,20 @@ class MainWindow(QMainWindow):
         deleteAction.triggered.connect(self.getDeleteDialog)
         canvasMenu.addAction(deleteAction)
 
+        # Undo
+        undoAction = QAction('&Undo', self)
+        undoAction.setStatusTip('Undo the last change')
+        undoAction.setShortcut('Ctrl+Z')
+        undoAction.triggered.connect(self.canvas.undo)
+        canvasMenu.addAction(undoAction)
+
+        # Redo
+        redoAction = QAction('Re&do', self)
+        redoAction.setStatusTip('Redo the last undone change')
+        redoAction.setShortcut('Ctrl+Y')
+        redoAction.triggered.connect(self.canvas.redo)
+        canvasMenu.addAction(redoAction)
+
     def getResetDialog(self):
         text, ok = QInputDialog().getText(self, f"Reset Canvas", "width height(empty for keep current size)", echo=QLineEdit.Normal)
         if not ok:
@@ -540,6 +670,7 @@ class MainWindow(QMainWindow):
             return
         self.id = 0
         self.canvas.clearElement()
+        self.canvas.history = History()
         self.size = (width, height)
         self.scene.clear()
         self.scene.setSceneRect(0, 0, width, height)
@@ -700,12 +831,12 @@ class MainWindow(QMainWindow):
         clipMenu = QMenu('&Clip', self)
         # Cohen-Sutherland
         clipActionCohen = QAction('&Cohen-Sutherland', self)
-        clipActionCohen.setStatusTip('Clip line with Cohen-Sutherland algorithm')
+        clipActionCohen.setStatusTip('Clip line or polygon with Cohen-Sutherland algorithm')
         clipActionCohen.triggered.connect(self.getClipDialog(Line.ClipAlgorithm.Cohen_Sutherland))
         clipMenu.addAction(clipActionCohen)
         # Liang-Barsky
         clipActionLiang = QAction('&Liang-Barsky', self)
-        clipActionLiang.setStatusTip('Clip line with Liang-Barsky algorithm')
+        clipActionLiang.setStatusTip('Clip line or polygon with Liang-Barsky algorithm')
         clipActionLiang.triggered.connect(self.getClipDialog(Line.ClipAlgorithm.Liang_Barsky))
         clipMenu.addAction(clipActionLiang)
         transformMenu.addMenu(clipMenu)
@@ -944,6 +1075,7 @@ class MainWindow(QMainWindow):
 
     def setColor(self, r: int, g: int, b: int):
         if self.canvas.selecting:
+            self.canvas.change(self.canvas.selecting.id)
             self.canvas.selecting.color = (r, g, b)
             self.canvas.updateElement(self.canvas.selecting.id)
         self.color = (r, g, b)
@@ -0,0 +1,77 @@
+import os
+import struct
+import numpy as np
+from PIL import Image
+
+# Writers for (height, width, 3) RGB canvases, top row first. Headers match
+# what PIL writes for 24-bit RGB images, so the files are byte-identical to
+# Image.save; other formats still go through PIL.
+
+BMP_PPM = 3780  # 96 dpi in pixels per meter
+
+
+def bmpRowBytes(width: int) -> int:
+    # rows are padded to a multiple of 4 bytes
+    return (width * 3 + 3) & ~3
+
+
+def bmpHeader(width: int, height: int) -> bytes:
+    image = bmpRowBytes(width) * height
+    size = 14 + 40 + image
+    if size > 0xFFFFFFFF:
+        # too large for the 32-bit size fields, which readers may leave 0
+        size = image = 0
+    return struct.pack(
+        "<2sIHHIIiiHHIIiiII",
+        b"BM", size, 0, 0, 14 + 40,
+        40, width, height, 1, 24, 0, image, BMP_PPM, BMP_PPM, 0, 0,
+    )
+
+
+BMP_CHUNK = 256  # rows converted per write
+
+
+def writeBMP(path: str, canvas: np.ndarray):
+    # BMP rows are bottom-up BGR, so the canvas is walked from its last row;
+    # only one chunk of rows is converted at a time
+    height, width, _ = canvas.shape
+    rowBytes = bmpRowBytes(width)
+    with open(path, "wb") as File:
+        File.write(bmpHeader(width, height))
+        for end in range(height, 0, -BMP_CHUNK):
+            start = max(end - BMP_CHUNK, 0)
+            chunk = np.zeros((end - start, rowBytes), np.uint8)
+            rows = np.lib.stride_tricks.as_strided(chunk, (end - start, width, 3), (rowBytes, 3, 1))
+            src = canvas[end - 1:start - 1 if start else None:-1]
+            # per-channel copies are much faster than one reversed-axis copy
+            rows[..., 0] = src[..., 2]
+            rows[..., 1] = src[..., 1]
+            rows[..., 2] = src[..., 0]
+            File.write(memoryview(chunk))
+
+
+def writePPM(path: str, canvas: np.ndarray):
+    height, width, _ = canvas.shape
+    with open(path, "wb") as File:
+        File.writelines([b"P6\n%d %d\n255\n" % (width, height), memoryview(np.ascontiguousarray(canvas))])
+
+
+def writeRaw(path: str, canvas: np.ndarray):
+    with open(path, "wb") as File:
+        File.write(memoryview(np.ascontiguousarray(canvas)))
+
+
+WRITERS = {
+    ".bmp": writeBMP,
+    ".ppm": writePPM,
+    ".raw": writeRaw,
+    ".rgb": writeRaw,
+}
+
+
+def writeImage(path: str, canvas: np.ndarray):
+    writer = WRITERS.get(os.path.splitext(path)[1].lower())
+    if writer and canvas.dtype == np.uint8 and canvas.ndim == 3 and canvas.shape[2] == 3:
+        writer(path, canvas)
+    else:
+        Image.fromarray(canvas).save(path)
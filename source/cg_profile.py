@@ -0,0 +1,84 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+# Opt-in timing for cg_cli. Board calls into a Profiler only when one is
+# attached, so the default path pays a single attribute check.
+
+
+class Profiler():
+    def __init__(self, trace: bool = False):
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+        # (category, name) -> [calls, seconds]
+        self.totals: Dict[Tuple[str, str], List[float]] = {}
+        # (id, algorithm) -> [calls, seconds, pixels]
+        self.rasters: Dict[Tuple[str, str], List[float]] = {}
+        # (path, seconds) per saved frame
+        self.frames: List[Tuple[str, float]] = []
+        self.events = [] if trace else None
+
+    @staticmethod
+    def fromEnvironment():
+        # CG_PROFILE=1 turns profiling on, CG_TRACE=<file> also keeps a trace
+        if os.environ.get("CG_PROFILE") or os.environ.get("CG_TRACE"):
+            return Profiler(bool(os.environ.get("CG_TRACE")))
+        return None
+
+    def record(self, category: str, name: str, start: float, end: float, **args):
+        with self.lock:
+            total = self.totals.setdefault((category, name), [0, 0.0])
+            total[0] += 1
+            total[1] += end - start
+            if self.events is not None:
+                self.events.append({
+                    "name": name, "cat": category, "ph": "X",
+                    "ts": (start - self.origin) * 1e6, "dur": (end - start) * 1e6,
+                    "pid": os.getpid(), "tid": threading.get_ident(), "args": args,
+                })
+
+    @contextmanager
+    def timed(self, category: str, name: str, **args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(category, name, start, time.perf_counter(), **args)
+
+    def raster(self, id: str, algorithm: str, start: float, end: float, pixels: int):
+        self.record("raster", algorithm, start, end, id=id, pixels=pixels)
+        with self.lock:
+            r = self.rasters.setdefault((id, algorithm), [0, 0.0, 0])
+            r[0] += 1
+            r[1] += end - start
+            r[2] += pixels
+
+    def frame(self, path: str, start: float, end: float):
+        self.record("saveCanvas", "encode", start, end, path=path)
+        with self.lock:
+            self.frames.append((path, end - start))
+
+    def summary(self, top: int = 10) -> str:
+        lines = ["{:12} {:20} {:>8} {:>10} {:>10}".format("category", "name", "calls", "total ms", "mean ms")]
+        for (category, name), (calls, seconds) in sorted(self.totals.items(), key=lambda kv: -kv[1][1]):
+            lines.append("{:12} {:20} {:8d} {:10.2f} {:10.3f}".format(
+                category, name, calls, seconds * 1e3, seconds * 1e3 / calls))
+        if self.rasters:
+            lines.append("")
+            lines.append("{:20} {:12} {:>8} {:>10} {:>10}".format("primitive", "algorithm", "calls", "total ms", "pixels"))
+            for (id, algorithm), (calls, seconds, pixels) in sorted(self.rasters.items(), key=lambda kv: -kv[1][1])[:top]:
+                lines.append("{:20} {:12} {:8d} {:10.2f} {:10d}".format(id, algorithm, calls, seconds * 1e3, pixels))
+        if self.frames:
+            lines.append("")
+            lines.append("{:40} {:>10}".format("saveCanvas", "encode ms"))
+            for path, seconds in sorted(self.frames, key=lambda f: -f[1])[:top]:
+                lines.append("{:40} {:10.2f}".format(os.path.basename(path), seconds * 1e3))
+        return "\n".join(lines)
+
+    def writeTrace(self, path: str):
+        # Chrome trace-event format, viewable in chrome://tracing or Perfetto
+        with open(path, "w") as File:
+            json.dump({"traceEvents": self.events or [], "displayTimeUnit": "ms"}, File)
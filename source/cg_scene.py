@@ -0,0 +1,133 @@
+from cg_algorithms import *
+import mmap
+import struct
+from typing import Iterator
+import numpy as np
+
+# Binary scene file, little endian:
+#   header   MAGIC, version, width, height, record count, id bytes, coord count
+#   records  one RECORD per primitive, in draw order
+#   coords   int32 values referenced by the records
+#   ids      utf-8 ids referenced by the records
+# Coordinates are the control points of each primitive: two points for a
+# line, the vertices of a polygon, the points of a curve, and cx, cy, rx, ry
+# for an ellipse. Pending transforms are applied before saving.
+
+MAGIC = b"CGSC"
+VERSION = 1
+HEADER = struct.Struct("<4sIiiIIQ")
+RECORD = np.dtype([
+    ("type", "u1"),
+    ("algorithm", "u1"),
+    ("color", "u1", (3,)),
+    ("pad", "u1", (3,)),
+    ("id", "<u4"),
+    ("idLength", "<u4"),
+    ("coords", "<u4"),
+    ("count", "<u4"),
+])
+
+
+def primitiveCoords(p: Primitive) -> List[int]:
+    p.applyTransform()
+    if p.type == Primitive.PType.line:
+        return [p.x0, p.y0, p.x1, p.y1]
+    if p.type == Primitive.PType.ellipse:
+        return [p.cx, p.cy, p.rx, p.ry]
+    return [v for point in p.controlPoints() for v in point]
+
+
+def makePrimitive(type: int, algorithm: int, coords: np.ndarray) -> Primitive:
+    t = Primitive.PType(type)
+    values = coords.tolist()
+    points = list(zip(values[0::2], values[1::2]))
+    if t == Primitive.PType.line:
+        return Line(*values, Line.Algorithm(algorithm))
+    if t == Primitive.PType.polygon:
+        return Polygon(points, Line.Algorithm(algorithm))
+    if t == Primitive.PType.filledPolygon:
+        return FilledPolygon(points, Line.Algorithm(algorithm))
+    if t == Primitive.PType.ellipse:
+        cx, cy, rx, ry = values
+        return Ellipse(cx - rx, cy - ry, cx + rx, cy + ry)
+    return Curve(points, Curve.Algorithm(algorithm))
+
+
+def writeScene(path: str, width: int, height: int, items: List[Tuple[str, Primitive, Color]]):
+    records = np.zeros(len(items), RECORD)
+    coords = []
+    ids = []
+    idBytes = 0
+    coordCount = 0
+    for i, (id, p, color) in enumerate(items):
+        values = primitiveCoords(p)
+        name = str(id).encode("utf-8")
+        r = records[i]
+        r["type"] = p.type.value
+        r["algorithm"] = p.algorithm.value if p.type != Primitive.PType.ellipse else 0
+        r["color"] = color
+        r["id"], r["idLength"] = idBytes, len(name)
+        r["coords"], r["count"] = coordCount, len(values)
+        coords.append(np.asarray(values, "<i4"))
+        ids.append(name)
+        idBytes += len(name)
+        coordCount += len(values)
+    with open(path, "wb") as File:
+        File.write(HEADER.pack(MAGIC, VERSION, width, height, len(items), idBytes, coordCount))
+        File.write(records.tobytes())
+        for c in coords:
+            File.write(c.tobytes())
+        File.write(b"".join(ids))
+
+
+# Read-only view of a scene file. records and coords are numpy arrays over
+# the mapped file, so nothing is copied until primitives are built.
+class Scene():
+    def __init__(self, path: str):
+        with open(path, "rb") as File:
+            self.map = mmap.mmap(File.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, self.width, self.height, count, idBytes, coordCount = HEADER.unpack_from(self.map)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError("Not a scene file: " + path)
+            offset = HEADER.size
+            self.records = np.frombuffer(self.map, RECORD, count, offset)
+            offset += RECORD.itemsize * count
+            self.coords = np.frombuffer(self.map, "<i4", coordCount, offset)
+            offset += 4 * coordCount
+            self.ids = memoryview(self.map)[offset:offset + idBytes]
+        except Exception:
+            self.close()
+            raise
+
+    def __len__(self):
+        return len(self.records)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        # views must be released before the map can be closed
+        self.records = self.coords = None
+        if getattr(self, "ids", None) is not None:
+            self.ids.release()
+            self.ids = None
+        self.map.close()
+
+    def id(self, i: int) -> str:
+        r = self.records[i]
+        return bytes(self.ids[r["id"]:r["id"] + r["idLength"]]).decode("utf-8")
+
+    def primitive(self, i: int) -> Primitive:
+        r = self.records[i]
+        return makePrimitive(r["type"], r["algorithm"], self.coords[r["coords"]:r["coords"] + r["count"]])
+
+    def color(self, i: int) -> Color:
+        return tuple(self.records[i]["color"].tolist())
+
+    def items(self) -> Iterator[Tuple[str, Primitive, Color]]:
+        for i in range(len(self.records)):
+            yield self.id(i), self.primitive(i), self.color(i)
@@ -0,0 +1,33 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "source"))
+
+from cg_algorithms import Ellipse
+from cg_cli import Board
+
+
+def test_quadrant_matches_scalar_below_int64_limit():
+    # largest radii still solved in int64, one step below the fallback
+    r = 1 << 15
+    e = Ellipse(0, 0, 2 * (r - 1), 2 * (r - 1))
+    assert 4 * e.rx ** 2 * e.ry ** 2 < Ellipse.INT64_LIMIT
+    assert (e.quadrant() == e.quadrantScalar()).all()
+
+
+def test_quadrant_above_int64_limit():
+    e = Ellipse(-39000, -39000, 39000, 39000)
+    assert 4 * e.rx ** 2 * e.ry ** 2 >= Ellipse.INT64_LIMIT
+    q = e.quadrant()
+    assert q[0].tolist() == [39000, 0]
+    assert q[-1].tolist() == [0, 39000]
+
+
+def test_board_renders_huge_ellipse(tmp_path):
+    board = Board(100, 100, str(tmp_path))
+    board.exec("drawEllipse e -39000 -39000 39000 39000")
+    board.exec("saveCanvas a")
+    board.exec("drawLine l 0 0 99 99 Bresenham")
+    board.exec("saveCanvas b")
+    assert (tmp_path / "a.bmp").exists() and (tmp_path / "b.bmp").exists()
+    assert (board.render() != 255).any()
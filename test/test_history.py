@@ -0,0 +1,70 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "source"))
+
+from cg_cli import Board
+
+
+def run(board: Board, script: str):
+    for line in script.strip().splitlines():
+        board.exec(line)
+
+
+def test_snapshot_undo_redo_round_trip():
+    board = Board(100, 100)
+    run(board, """
+        drawLine a 0 0 10 0 Bresenham
+        drawEllipse e 40 40 60 70
+        snapshot
+        translate a 10 5
+        setColor 255 0 0
+        drawLine b 0 99 99 0 DDA
+        clip e 0 0 20 20 Liang-Barsky
+    """)
+    before_undo = board.render().copy()
+    board.undo()
+    assert set(board.primitives) == {"a", "e"}
+    after_undo = board.render().copy()
+    fresh = Board(100, 100)
+    run(fresh, """
+        drawLine a 0 0 10 0 Bresenham
+        drawEllipse e 40 40 60 70
+    """)
+    assert (after_undo == fresh.render()).all()
+    board.redo()
+    assert (board.render() == before_undo).all()
+
+
+def test_edit_after_undo_clears_redo():
+    board = Board(100, 100)
+    run(board, """
+        drawLine a 0 0 10 0 Bresenham
+        snapshot
+        translate a 10 0
+        undo
+        translate a 50 50
+        redo
+    """)
+    line = board.primitives["a"][0]
+    line.applyTransform()
+    assert (line.x0, line.y0, line.x1, line.y1) == (50, 50, 60, 50)
+
+
+def test_repeated_edit_after_undo_clears_redo():
+    # the id is already recorded in the open step, the edit must still
+    # drop the undone step
+    board = Board(100, 100)
+    run(board, """
+        drawLine a 0 0 10 0 Bresenham
+        snapshot
+        translate a 10 0
+        snapshot
+        translate a 5 0
+        undo
+        translate a 50 50
+        redo
+    """)
+    line = board.primitives["a"][0]
+    line.applyTransform()
+    assert (line.x0, line.y0, line.x1, line.y1) == (60, 50, 70, 50)